@@ -0,0 +1,222 @@
+"""
+Benchmark harness for the teacher guide index pipeline.
+
+Generates a synthetic workbook PDF with ReportLab, swaps ChatAnthropic for a local fake
+chat model that returns canned index text after a configurable latency, and runs each
+pipeline stage under PipelineMetrics, reporting time, throughput and peak RSS per stage.
+No API token or network access is needed, so results can be compared across releases:
+
+    python benchmark_teacher_index.py --pages 400 --latency 2.0 --output bench.json
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import re
+import time
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from reportlab.lib.pagesizes import letter
+from reportlab.pdfgen import canvas
+
+import teacher_index
+
+FILLER_WORDS = (
+    "read the words aloud with a partner then circle the picture that matches each sentence "
+    "write a sentence about your favorite part of the story and share it with the class"
+).split()
+
+
+def make_synthetic_workbook(path, pages=300, lines_per_page=30, seed=0):
+    """
+    Writes a workbook-like PDF: running header and footer on every page, a lesson heading,
+    and body lines mixing reference-index vocabulary with filler sentences.
+    """
+    rng = random.Random(seed)
+    vocabulary = teacher_index.reference_vocabulary()
+    pdf = canvas.Canvas(path, pagesize=letter)
+    width, height = letter
+    for page in range(1, pages + 1):
+        unit = (page - 1) // 50 + 1
+        pdf.setFont("Helvetica", 9)
+        pdf.drawString(54, height - 40, "The Superkids Reading Program - Student Workbook")
+        pdf.drawString(width / 2, 30, f"Unit {unit} • {page}")
+        pdf.setFont("Helvetica-Bold", 14)
+        pdf.drawString(54, height - 80, f"Lesson {page}: {rng.choice(vocabulary)}")
+        pdf.setFont("Helvetica", 10)
+        y = height - 110
+        for _ in range(lines_per_page):
+            words = rng.sample(FILLER_WORDS, 8)
+            words.insert(rng.randrange(len(words)), rng.choice(vocabulary))
+            pdf.drawString(54, y, " ".join(words).capitalize() + ".")
+            y -= 20
+        pdf.showPage()
+    pdf.save()
+
+
+class FakeIndexChatModel(BaseChatModel):
+    """
+    Local stand-in for ChatAnthropic. Replies after `latency` seconds with a canned index
+    citing the pages present in the request, streams it line by line, and reports usage
+    metadata with estimated token counts, so the whole pipeline runs without API calls.
+    """
+    latency: float = 0.5
+    entries_per_request: int = 40
+
+    @property
+    def _llm_type(self):
+        return "fake-index"
+
+    def get_num_tokens(self, text):
+        return teacher_index._estimate_tokens(text)
+
+    def get_num_tokens_from_messages(self, messages, tools=None):
+        return sum(self.get_num_tokens(self._text(message)) for message in messages)
+
+    @staticmethod
+    def _text(message):
+        return teacher_index._message_text(message)
+
+    def _canned_index(self, messages):
+        prompt = "".join(self._text(message) for message in messages)
+        pages = [int(page) for page in re.findall(r"--- Page (\d+) ---", prompt)] or [1]
+        vocabulary = teacher_index.reference_vocabulary()
+        rng = random.Random(pages[0])
+        lines = []
+        for heading in sorted(rng.sample(vocabulary, min(self.entries_per_request, len(vocabulary))), key=str.casefold):
+            cited = sorted(rng.sample(pages, min(3, len(pages))))
+            lines.append(f"{heading}: {', '.join(f'Page {page}' for page in cited)}")
+        lines.append(teacher_index.END_OF_INDEX_MARKER)
+        return "\n".join(lines), teacher_index._estimate_tokens(prompt)
+
+    def _message(self, text, input_tokens):
+        output_tokens = teacher_index._estimate_tokens(text)
+        return AIMessage(
+            content=text,
+            response_metadata={"stop_reason": "end_turn"},
+            usage_metadata={"input_tokens": input_tokens, "output_tokens": output_tokens,
+                            "total_tokens": input_tokens + output_tokens},
+        )
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.latency)
+        text, input_tokens = self._canned_index(messages)
+        return ChatResult(generations=[ChatGeneration(message=self._message(text, input_tokens))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        text, input_tokens = self._canned_index(messages)
+        return ChatResult(generations=[ChatGeneration(message=self._message(text, input_tokens))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        text, input_tokens = self._canned_index(messages)
+        lines = text.split("\n")
+        # Time to first token is a fixed share of the latency; the rest is spread over the lines.
+        time.sleep(self.latency * 0.2)
+        for i, line in enumerate(lines):
+            time.sleep(self.latency * 0.8 / len(lines))
+            chunk = AIMessageChunk(content=line + ("\n" if i < len(lines) - 1 else ""))
+            if i == len(lines) - 1:
+                output_tokens = teacher_index._estimate_tokens(text)
+                chunk = AIMessageChunk(
+                    content=chunk.content,
+                    response_metadata={"stop_reason": "end_turn"},
+                    usage_metadata={"input_tokens": input_tokens, "output_tokens": output_tokens,
+                                    "total_tokens": input_tokens + output_tokens},
+                )
+            yield ChatGenerationChunk(message=chunk)
+
+
+def run_benchmark(pdf_path, latency, workers, concurrency):
+    """Runs every pipeline stage on pdf_path with the fake model; returns the metrics events."""
+    metrics = teacher_index.PipelineMetrics(log_path=None)
+    chat_model = FakeIndexChatModel(latency=latency)
+    with open(pdf_path, "rb") as f:
+        pdf_bytes = f.read()
+
+    with metrics.stage("extract_serial") as event:
+        pages = teacher_index.extract_text_with_page_numbers(pdf_bytes, workers=1)
+        event["pages"] = len(pages)
+    with metrics.stage("extract_parallel", workers=workers) as event:
+        parallel_pages = teacher_index.extract_text_with_page_numbers(pdf_bytes, workers=workers)
+        event.update(pages=len(parallel_pages), identical_to_serial=parallel_pages == pages)
+
+    with metrics.stage("preprocess", pages=len(pages)) as event:
+        llm_pages = teacher_index.preprocess_pages(pages)
+        term_index, page_terms = teacher_index.build_term_index(llm_pages)
+        event.update(
+            terms=len(term_index),
+            characters_extracted=sum(len(item["text"]) for item in pages),
+            characters_after=sum(len(item["text"]) for item in llm_pages),
+        )
+
+    request_stats = []
+    with metrics.stage("generate_single", pages=len(llm_pages)) as event:
+        first_line_at = None
+        started = time.perf_counter()
+        lines = []
+        for line in teacher_index.stream_index_lines(chat_model, llm_pages, request_stats):
+            if first_line_at is None:
+                first_line_at = time.perf_counter() - started
+            lines.append(line)
+        event.update(
+            teacher_index.summarize_request_stats(request_stats),
+            # None when the model streamed no index lines at all
+            first_line_seconds=round(first_line_at, 3) if first_line_at is not None else None,
+        )
+
+    request_stats = []
+    with metrics.stage("generate_map_reduce", pages=len(llm_pages), concurrency=concurrency) as event:
+        index_text = teacher_index.generate_teacher_guide_index_map_reduce(
+            chat_model, llm_pages, concurrency=concurrency, request_stats=request_stats
+        )
+        event.update(teacher_index.summarize_request_stats(request_stats))
+
+    with metrics.stage("render") as event:
+        parsed = teacher_index.parse_index_text(index_text)
+        output = teacher_index.create_pdf_from_text(index_text, io.BytesIO(), parsed=parsed)
+        event.update(entries=sum(1 for _ in parsed.root.walk()), bytes=len(output.getvalue()))
+
+    return metrics.events
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the teacher guide index pipeline with a stubbed LLM.")
+    parser.add_argument("--pages", type=int, default=300, help="Pages in the synthetic workbook")
+    parser.add_argument("--lines-per-page", type=int, default=30)
+    parser.add_argument("--latency", type=float, default=0.5, help="Seconds the fake model takes per request")
+    parser.add_argument("--workers", type=int, default=teacher_index.EXTRACTION_WORKERS, help="Extraction processes")
+    parser.add_argument("--concurrency", type=int, default=teacher_index.LLM_CONCURRENCY, help="Concurrent map-reduce requests")
+    parser.add_argument("--pdf", help="Benchmark an existing PDF instead of generating one")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    pdf_path = args.pdf
+    if not pdf_path:
+        pdf_path = f"benchmark_workbook_{args.pages}p.pdf"
+        started = time.perf_counter()
+        make_synthetic_workbook(pdf_path, args.pages, args.lines_per_page)
+        print(f"Generated {pdf_path} ({args.pages} pages) in {time.perf_counter() - started:.1f}s")
+
+    try:
+        events = run_benchmark(pdf_path, args.latency, args.workers, args.concurrency)
+    finally:
+        if not args.pdf:
+            os.remove(pdf_path)
+
+    print(f"{'stage':<22}{'seconds':>9}{'pages/s':>10}{'peak RSS MB':>13}")
+    for event in events:
+        print(f"{event['stage']:<22}{event['seconds']:>9.2f}{event.get('pages_per_second', ''):>10}{event['rss_peak_mb']:>13}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "events": events}, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
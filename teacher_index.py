@@ -1,60 +1,227 @@
+import argparse
+import asyncio
+import hashlib
+import io
+import json
+import multiprocessing.util
 import os
+import random
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from xml.sax.saxutils import escape
 import streamlit as st #
+from streamlit import runtime
 import pdfplumber
-from langchain_anthropic import ChatAnthropic
 from langchain_core.messages import HumanMessage, AIMessage
-from reportlab.lib.pagesizes import letter
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.enums import TA_LEFT
 from dotenv import load_dotenv
+# langchain_anthropic and reportlab are imported where they are first needed, to keep
+# cold starts and Streamlit reruns that never reach the LLM or PDF rendering fast.
 
 load_dotenv()
 
-def initialize_chat_model():
+
+def _in_streamlit():
+    """True when running under `streamlit run`; otherwise messages go to stdout."""
+    return runtime.exists()
+
+
+INDEX_MODEL_NAME = "claude-3-haiku-20240307"
+INDEX_MAX_TOKENS = 4096
+# Retries made by the Anthropic SDK itself (its default). Callers with their own retry
+# policy, such as map-reduce generation, ask for a client with max_retries=0.
+SDK_MAX_RETRIES = 2
+
+
+@st.cache_resource(show_spinner=False)
+def _shared_chat_model(token, max_retries=SDK_MAX_RETRIES):
+    """
+    One ChatAnthropic client per token and retry setting for the whole process, so its HTTP
+    connection pool is kept alive and reused across Streamlit reruns and sessions instead
+    of rebuilt each time.
     """
-    Initializes and returns a ChatAnthropic model.
+    from langchain_anthropic import ChatAnthropic
+
+    return ChatAnthropic(
+        anthropic_api_key=f'{token}:my-test-project',
+        base_url="https://llmfoundry.straive.com/anthropic/",
+        model_name=INDEX_MODEL_NAME,
+        max_tokens=INDEX_MAX_TOKENS,
+        max_retries=max_retries
+    )
+
+
+def initialize_chat_model(max_retries=SDK_MAX_RETRIES):
+    """
+    Initializes and returns a ChatAnthropic model, shared process-wide.
     Expects LLMFOUNDRY_TOKEN environment variable to be set.
     """
     try:
         token = os.getenv("LLMFOUNDRY_TOKEN")
         if not token:
-            if 'st' in globals():
+            if _in_streamlit():
                 st.error("LLMFOUNDRY_TOKEN environment variable not found. Please set it.")
             else:
                 print("Error: LLMFOUNDRY_TOKEN environment variable not found. Please set it.")
             return None
 
-        chat_model = ChatAnthropic(
-            anthropic_api_key=f'{token}:my-test-project',
-            base_url="https://llmfoundry.straive.com/anthropic/",
-            model_name="claude-3-haiku-20240307",
-             max_tokens=4096
-        )
+        chat_model = _shared_chat_model(token, max_retries)
         return chat_model
     except Exception as e:
-        if 'st' in globals():
+        if _in_streamlit():
             st.error(f"Failed to initialize AI model: {str(e)}")
         else:
             print(f"Error: Failed to initialize AI model: {str(e)}")
         return None
 
 
-def extract_text_with_page_numbers(pdf_path):
+# Pages handed to each extraction worker at a time. Large enough to amortise the cost of
+# re-opening the PDF in every worker, small enough to keep results flowing in page order.
+EXTRACTION_SHARD_SIZE = 25
+# Default worker count for extraction; 1 forces the serial path.
+EXTRACTION_WORKERS = int(os.getenv("EXTRACTION_WORKERS", os.cpu_count() or 1))
+# Uploads larger than this are spilled to a private temporary file instead of being
+# processed from memory.
+PDF_SPILL_BYTES = int(os.getenv("PDF_SPILL_BYTES", 64 * 1024 * 1024))
+
+# PDF source (path or bytes) of the current extraction worker process, set once per worker,
+# and the pdfplumber handle the worker opens on it for its first shard and reuses after.
+_worker_pdf_source = None
+_worker_pdf = None
+
+
+def _open_pdf(pdf_source):
+    """Opens a PDF given as a file path or as in-memory bytes (bytes, bytearray or memoryview)."""
+    if isinstance(pdf_source, (bytes, bytearray, memoryview)):
+        return pdfplumber.open(io.BytesIO(pdf_source))
+    return pdfplumber.open(pdf_source)
+
+
+@contextmanager
+def spooled_pdf_source(pdf_bytes, spill_bytes=PDF_SPILL_BYTES):
     """
-    Extracts text from a PDF, associating each text block with its page number.
-    Returns a list of dictionaries: [{"page": 1, "text": "..."}]
+    Yields a PDF source for extraction: the in-memory bytes themselves, or, above
+    spill_bytes, the path of a private temporary copy that is deleted afterwards.
     """
-    pages_content = []
+    if len(pdf_bytes) <= spill_bytes:
+        yield pdf_bytes
+        return
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as f:
+        f.write(pdf_bytes)
     try:
-        with pdfplumber.open(pdf_path) as pdf:
+        yield f.name
+    finally:
+        os.remove(f.name)
+
+
+def _extract_page_text(page):
+    """
+    Extracts the text of a single pdfplumber page and releases its layout caches,
+    so memory does not grow with the number of pages already processed.
+    """
+    try:
+        return page.extract_text()
+    finally:
+        page.close()
+
+
+def _close_worker_pdf():
+    global _worker_pdf
+    if _worker_pdf is not None:
+        _worker_pdf.close()
+        _worker_pdf = None
+
+
+def _init_extraction_worker(pdf_source):
+    # Sent once per worker rather than with every shard, which matters for in-memory PDFs.
+    global _worker_pdf_source
+    _worker_pdf_source = pdf_source
+    # Pool workers skip atexit handlers, but run multiprocessing finalizers on a clean exit.
+    multiprocessing.util.Finalize(None, _close_worker_pdf, exitpriority=0)
+
+
+def _extract_page_range(start, stop):
+    """
+    Process-pool worker: extracts pages [start, stop) with the worker's own pdfplumber handle.
+    The handle is opened once per worker, as opening it parses the whole page tree, and
+    closed when the worker exits.
+    Returns a list of {"page": n, "text": "..."} records for pages that contain text.
+    """
+    global _worker_pdf
+    if _worker_pdf is None:
+        _worker_pdf = _open_pdf(_worker_pdf_source)
+    records = []
+    for i in range(start, stop):
+        text = _extract_page_text(_worker_pdf.pages[i])
+        if text:
+            records.append({"page": i + 1, "text": text})
+    return records
+
+
+def iter_text_with_page_numbers(pdf_source, workers=None, shard_size=EXTRACTION_SHARD_SIZE):
+    """
+    Generator form of extract_text_with_page_numbers: yields {"page": 1, "text": "..."}
+    records in page order as soon as they are available.
+    With workers > 1 the page range is sharded across a process pool (each worker opens
+    its own pdfplumber handle); with workers == 1 pages are extracted serially in-process.
+    Both paths produce identical records.
+    """
+    if workers is None:
+        workers = EXTRACTION_WORKERS
+
+    with _open_pdf(pdf_source) as pdf:
+        page_count = len(pdf.pages)
+        if workers <= 1 or page_count <= shard_size:
             for i, page in enumerate(pdf.pages):
-                page_number = i + 1
-                text = page.extract_text()
+                text = _extract_page_text(page)
                 if text:
-                    pages_content.append({"page": page_number, "text": text})
+                    yield {"page": i + 1, "text": text}
+            return
+
+    shards = [(start, min(start + shard_size, page_count)) for start in range(0, page_count, shard_size)]
+    workers = min(workers, len(shards))
+    # Keep a bounded number of shards in flight so finished-but-unconsumed results
+    # cannot pile up in memory when the consumer is slower than the pool.
+    max_in_flight = workers * 2
+    if isinstance(pdf_source, memoryview):
+        pdf_source = bytes(pdf_source) # memoryviews cannot be pickled for the workers
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_extraction_worker,
+                             initargs=(pdf_source,)) as executor:
+        pending = deque()
+        next_shard = 0
+        while next_shard < len(shards) or pending:
+            while next_shard < len(shards) and len(pending) < max_in_flight:
+                start, stop = shards[next_shard]
+                pending.append(executor.submit(_extract_page_range, start, stop))
+                next_shard += 1
+            yield from pending.popleft().result()
+
+
+def extract_text_with_page_numbers(pdf_source, workers=None):
+    """
+    Extracts text from a PDF, associating each text block with its page number.
+    pdf_source is a file path or the PDF's bytes (e.g. an uploaded file's buffer).
+    Returns a list of dictionaries: [{"page": 1, "text": "..."}]
+    Set workers=1 to force serial extraction; by default pages are extracted in parallel.
+    """
+    try:
+        try:
+            pages_content = list(iter_text_with_page_numbers(pdf_source, workers=workers))
+        except (BrokenProcessPool, OSError, NotImplementedError):
+            # Worker processes could not be created or started (e.g. a restricted environment
+            # without /dev/shm or fork); the serial path yields exactly the same records.
+            pages_content = list(iter_text_with_page_numbers(pdf_source, workers=1))
     except Exception as e:
-        if 'st' in globals():
+        if _in_streamlit():
             st.error(f"Error extracting text from PDF: {str(e)}")
         else:
             print(f"Error extracting text from PDF: {str(e)}")
@@ -62,51 +229,9 @@ def extract_text_with_page_numbers(pdf_path):
     return pages_content
 
 
-def generate_teacher_guide_index_with_llm(chat_model, pdf_text_with_pages):
-    """
-    Sends extracted PDF text to the LLM with a prompt to generate a teacher guide index
-    mimicking the structure of 'SK17 G1 Index (1).pdf'.
-    Includes chunking logic for the input to manage large documents.
-    Adds instructions for the LLM to indicate completion or truncation.
-    """
-    if not chat_model:
-        return "LLM model not initialized."
-
-    # Construct the input string for the LLM
-    # THIS PROMPT IS NOW CRITICAL FOR MIMICKING THE TARGET FORMAT AND HANDLING COMPLETION.
-    base_prompt = "Analyze the following text extracted from a student workbook. " \
-                  "Your task is to create a 'Teacher's Guide Index' from this content. " \
-                  "The index should be structured and formatted exactly like a professional index " \
-                  "found in a teacher's guide, similar to the 'SK17 G1 Index (1).pdf' example.\n\n" \
-                  "Follow these strict formatting rules:\n" \
-                  "1.  **Alphabetical Order:** All top-level entries must be sorted alphabetically.\n" \
-                  "2.  **Main Entries:** Identify broad educational concepts, skills, or topics. " \
-                  "    Each main entry should be on its own line, followed by a colon if it has sub-entries.\n" \
-                  "3.  **Sub-Entries:** Indent specific details or sub-topics under their main entries. " \
-                  "    Each sub-entry should be on its own line, beginning with an indent.\n" \
-                  "4.  **Page Referencing:** For each entry (main or sub), list the page numbers where the concept is found. " \
-                  "    The format should be 'Page X, Page Y' or 'Pages X-Y' if a range. " \
-                  "    **IMPORTANT:** If you can infer a 'Unit' (e.g., from context or numbering in the original document), " \
-                  "    format it as 'Unit/Page' (e.g., '1/101'). If no unit is discernible, just use 'Page X'.\n" \
-                  "5.  **Cross-Referencing ('See' and 'See also'):** Use 'See [Other Topic]' to direct users to the preferred or more comprehensive entry for a topic. " \
-                  "    Place this on a new line after the entry, or as a standalone entry if the term itself is just a redirect. " \
-                  "    For example: 'Abbreviations, understand. See Vocabulary.'\n" \
-                  "6.  **Conciseness:** Keep entries brief and to the point.\n" \
-                  "7.  **Punctuation:** Use consistent punctuation (e.g., comma-separated page numbers, period at end of some entries if they are sentences).\n\n" \
-                  "**Crucial Instruction:** Ensure the index is exhaustive for the provided content. At the very end of the generated index, add the phrase '--- END OF INDEX ---'. " \
-                  "If, for any reason, you are unable to complete the full index due to length, clearly state '--- INDEX INCOMPLETE ---' at the point of truncation.\n\n" \
-                  "Example Format (Adhere strictly to this structure for *all* entries you generate):\n" \
-                  "Assessment:\n" \
-                  "  End-of-Unit Assessment: Page 101, Page 98\n" \
-                  "  Informal Assessment: See Daily Routines\n" \
-                  "Fluency:\n" \
-                  "  Accuracy, read with. See Fluency.\n" \
-                  "  Words correct per minute (WCPM): Page 55\n" \
-                  "Phonics:\n" \
-                  "  Long Vowels:\n" \
-                  "    ai/ay: Page 4, Page 5\n" \
-                  "  Short vowels: Page 122\n\n" \
-                  """A - Abbreviations, understand. Accuracy, read with. Adjectives, understand. Adverbs, understand. Alphabetical order, use. Answer questions about literary and informational text. Antonyms, understand. Apostrophes, recognize and use. Art activities. Assessment End-of-Unit Assessment Informal Assessment Placement Test Progress tests Spelling tests
+# A-Z listing of the reference SK17 G1 index, embedded in the prompt as a model of the
+# expected entries and used locally as the vocabulary for pre-indexing.
+REFERENCE_INDEX_LISTING = """A - Abbreviations, understand. Accuracy, read with. Adjectives, understand. Adverbs, understand. Alphabetical order, use. Answer questions about literary and informational text. Antonyms, understand. Apostrophes, recognize and use. Art activities. Assessment End-of-Unit Assessment Informal Assessment Placement Test Progress tests Spelling tests
 
 B - Base words, identify. Blend sounds to decode words.
 
@@ -148,104 +273,1300 @@ T - Teacher Read-Aloud Suggestions. Ten-Minute Tuck-Ins: Activities for Differen
 
 V - Verbs, understand. Verbs, use to understand time of action. Visualize. Vocabulary Abbreviations, understand Antonyms, understand Categorizing Compound words, understand Context clues, use Descriptive language, appreciate and use Figurative language, appreciate and use Homographs, understand Homonyms, understand Homophones, understand Idioms, understand Informational text words, discuss Interjections Literary text words, discuss Memory Words, understand Multiple-meaning words, understand Onomatopoeia (words for sounds), discuss Rebuses, identify Sequence words, understand Superkids’ names, recognize Synonyms, understand Words to Know
 
-Vowels. Word Families. Writing Composition Products Address on an envelope Answers to questions Books Descriptions Directions (How-to) E-mails Fact cards Facts Friendly letter Illustrations Informative writing Labels Lists Memory Book Messages Notes Opinions Paragraphs Personal narratives Poetry Questions Research Questions Review (play or book) Riddles Sentences Sign Stories (Narratives) Summaries Skills Add details to pictures or writing Contribute ideas to group writing Edit writing Feedback, give Generate ideas before writing Organize ideas in sequential order Partners, work with Plan writing Publish writing Revise writing Select a topic to write about Set a purpose for writing Spelling, use temporary Staying on topic Text Types Informative/explanatory Narrative Opinion Writing Rubrics Descriptive Writing Explanatory Writing Informative and Correspondence Writing Informative Writing Narrative and Opinion Writing Narrative Writing Opinion Writing Poetry Written directions, follow """\
-                  "Here is the content from the student workbook to create the index from:\n\n"
+Vowels. Word Families. Writing Composition Products Address on an envelope Answers to questions Books Descriptions Directions (How-to) E-mails Fact cards Facts Friendly letter Illustrations Informative writing Labels Lists Memory Book Messages Notes Opinions Paragraphs Personal narratives Poetry Questions Research Questions Review (play or book) Riddles Sentences Sign Stories (Narratives) Summaries Skills Add details to pictures or writing Contribute ideas to group writing Edit writing Feedback, give Generate ideas before writing Organize ideas in sequential order Partners, work with Plan writing Publish writing Revise writing Select a topic to write about Set a purpose for writing Spelling, use temporary Staying on topic Text Types Informative/explanatory Narrative Opinion Writing Rubrics Descriptive Writing Explanatory Writing Informative and Correspondence Writing Informative Writing Narrative and Opinion Writing Narrative Writing Opinion Writing Poetry Written directions, follow """
+
+# Static part of the index prompt: formatting rules plus the reference SK17 G1 listing.
+# THIS PROMPT IS CRITICAL FOR MIMICKING THE TARGET FORMAT AND HANDLING COMPLETION.
+INDEX_BASE_PROMPT = "Analyze the following text extracted from a student workbook. " \
+                    "Your task is to create a 'Teacher's Guide Index' from this content. " \
+                    "The index should be structured and formatted exactly like a professional index " \
+                    "found in a teacher's guide, similar to the 'SK17 G1 Index (1).pdf' example.\n\n" \
+                    "Follow these strict formatting rules:\n" \
+                    "1.  **Alphabetical Order:** All top-level entries must be sorted alphabetically.\n" \
+                    "2.  **Main Entries:** Identify broad educational concepts, skills, or topics. " \
+                    "    Each main entry should be on its own line, followed by a colon if it has sub-entries.\n" \
+                    "3.  **Sub-Entries:** Indent specific details or sub-topics under their main entries. " \
+                    "    Each sub-entry should be on its own line, beginning with an indent.\n" \
+                    "4.  **Page Referencing:** For each entry (main or sub), list the page numbers where the concept is found. " \
+                    "    The format should be 'Page X, Page Y' or 'Pages X-Y' if a range. " \
+                    "    **IMPORTANT:** If you can infer a 'Unit' (e.g., from context or numbering in the original document), " \
+                    "    format it as 'Unit/Page' (e.g., '1/101'). If no unit is discernible, just use 'Page X'.\n" \
+                    "5.  **Cross-Referencing ('See' and 'See also'):** Use 'See [Other Topic]' to direct users to the preferred or more comprehensive entry for a topic. " \
+                    "    Place this on a new line after the entry, or as a standalone entry if the term itself is just a redirect. " \
+                    "    For example: 'Abbreviations, understand. See Vocabulary.'\n" \
+                    "6.  **Conciseness:** Keep entries brief and to the point.\n" \
+                    "7.  **Punctuation:** Use consistent punctuation (e.g., comma-separated page numbers, period at end of some entries if they are sentences).\n" \
+                    "8.  **Index Lines Only:** Output only index entries and the end marker: no introduction, letter headings, commentary or closing remarks.\n\n" \
+                    "**Crucial Instruction:** Ensure the index is exhaustive for the provided content. At the very end of the generated index, add the phrase '--- END OF INDEX ---'. " \
+                    "If, for any reason, you are unable to complete the full index due to length, clearly state '--- INDEX INCOMPLETE ---' at the point of truncation.\n\n" \
+                    "Example Format (Adhere strictly to this structure for *all* entries you generate):\n" \
+                    "Assessment:\n" \
+                    "  End-of-Unit Assessment: Page 101, Page 98\n" \
+                    "  Informal Assessment: See Daily Routines\n" \
+                    "Fluency:\n" \
+                    "  Accuracy, read with. See Fluency.\n" \
+                    "  Words correct per minute (WCPM): Page 55\n" \
+                    "Phonics:\n" \
+                    "  Long Vowels:\n" \
+                    "    ai/ay: Page 4, Page 5\n" \
+                    "  Short vowels: Page 122\n\n" + \
+                    REFERENCE_INDEX_LISTING + \
+                    "Here is the content from the student workbook to create the index from:\n\n"
+
+
+# --- Local pre-indexing ---
+# Lines at the top and bottom of each page that are checked for running headers/footers.
+HEADER_FOOTER_EDGE_LINES = 3
+# A line is a running header/footer if it recurs (ignoring digits) on this share of pages.
+HEADER_FOOTER_MIN_FRACTION = 0.3
+# Bumped whenever preprocessing changes what is sent to the LLM, to invalidate cached indexes.
+PREPROCESS_VERSION = 2
+
+HEADING_SMALL_WORDS = {"a", "an", "and", "as", "at", "for", "in", "of", "on", "or", "the", "to", "with"}
+QUOTED_TITLE_PATTERN = re.compile(r"[“\"]([^”\"\n]{2,80})[”\"]")
+
+_reference_vocabulary = None
+
+
+def _line_signature(line):
+    # Page numbers differ from page to page, so digits are ignored in short lines
+    # ('Unit 3 • Page 45'); longer lines must recur verbatim to count as running heads.
+    line = " ".join(line.split()).casefold()
+    return re.sub(r"\d+", "#", line) if len(line.split()) <= 5 else line
+
+
+def _edge_line_indexes(line_count, edge_lines):
+    # On short pages only the outer third counts as header/footer territory.
+    edge = min(edge_lines, max(1, line_count // 3))
+    return set(range(edge)) | set(range(max(0, line_count - edge), line_count))
+
+
+def preprocess_pages(pdf_text_with_pages, edge_lines=HEADER_FOOTER_EDGE_LINES, min_fraction=HEADER_FOOTER_MIN_FRACTION):
+    """
+    Returns new page records with running headers/footers removed (lines near the top or
+    bottom of a page that recur, ignoring digits, on at least min_fraction of the pages)
+    and whitespace collapsed. Pages left without text are dropped.
+    """
+    split_pages = [[" ".join(line.split()) for line in item["text"].split("\n")] for item in pdf_text_with_pages]
+    split_pages = [[line for line in lines if line] for lines in split_pages]
+
+    edge_counts = {}
+    for lines in split_pages:
+        edges = _edge_line_indexes(len(lines), edge_lines)
+        for signature in {_line_signature(lines[i]) for i in edges}:
+            edge_counts[signature] = edge_counts.get(signature, 0) + 1
+    threshold = max(3, min_fraction * len(split_pages))
+    repeated = {signature for signature, count in edge_counts.items() if count >= threshold}
+
+    cleaned = []
+    for item, lines in zip(pdf_text_with_pages, split_pages):
+        edges = _edge_line_indexes(len(lines), edge_lines)
+        kept = [line for i, line in enumerate(lines) if i not in edges or _line_signature(line) not in repeated]
+        if kept:
+            cleaned.append({"page": item["page"], "text": "\n".join(kept)})
+    return cleaned
+
+
+def _is_clean_head(head):
+    # A single entry head is title case throughout ('Print and Book Awareness') or sentence
+    # case ('Compound words'); anything else is several run-together sub-entries
+    # ('Independent Activities Initial sounds', 'Spelling tests Stories').
+    capitals = [word[:1].isupper() for word in head.split() if word.lower() not in HEADING_SMALL_WORDS]
+    return bool(capitals) and capitals[0] and (all(capitals) or not any(capitals[1:]))
+
+
+def reference_vocabulary():
+    """
+    Terms from REFERENCE_INDEX_LISTING: quoted titles plus the head of each short entry
+    ('Abbreviations, understand.' gives 'Abbreviations'). Run-on groups of sub-entries
+    ('Fluency Accuracy, read with Expression, ...') only contribute a head ended by a colon
+    ('Daily Routines: ...'), as the boundaries between their sub-entries cannot be recovered.
+    """
+    global _reference_vocabulary
+    if _reference_vocabulary is None:
+        terms = {}
+        for title in re.findall(r"“([^”]+)”", REFERENCE_INDEX_LISTING):
+            terms.setdefault(collation_key(title), title.strip())
+        text = re.sub(r"“[^”]+”", ". ", REFERENCE_INDEX_LISTING)
+        text = re.sub(r"(?m)^[A-Z] - ", "", text)
+        for segment in re.split(r"\.\s+|\n+", text):
+            words = segment.split()
+            if len(words) > 6 and words[0][:1].isupper() and words[1][:1].isupper():
+                colon_head = re.match(r"([^,:]+):", segment)
+                head = colon_head.group(1).strip() if colon_head and len(colon_head.group(1).split()) <= 4 else ""
+            else:
+                head = segment.split(",")[0].split(":")[0].strip(" .")
+            if len(head) >= 3 and len(head.split()) <= 4 and _is_clean_head(head):
+                terms.setdefault(collation_key(head), head)
+        _reference_vocabulary = list(terms.values())
+    return _reference_vocabulary
+
+
+def _vocabulary_pattern():
+    # Only multi-word terms are matched in running text: single words such as 'Rate' or
+    # 'Directions' are ordinary prose and are picked up only as heading lines.
+    # Longest terms first so 'Compound words' wins over a shorter overlapping term.
+    terms = sorted((term for term in reference_vocabulary() if len(term.split()) > 1), key=len, reverse=True)
+    return re.compile(r"(?<!\w)(?:" + "|".join(re.escape(term) for term in terms) + r")(?!\w)", re.IGNORECASE)
 
-    MAX_LLM_INPUT_LENGTH = 900000  # Character limit for the combined prompt and PDF content
-    input_text = base_prompt
-    current_input_length = len(input_text)
-    pdf_content_to_send = ""
-    truncated_input = False
 
+def _is_heading_line(line):
+    words = line.split()
+    if not 1 <= len(words) <= 6 or line.endswith((".", ",", ";")) or not re.search(r"[A-Za-z]{3}", line):
+        return False
+    return all(word[0].isupper() or word.lower() in HEADING_SMALL_WORDS for word in words if word[0].isalpha())
+
+
+def extract_page_terms(text, vocabulary_pattern=None):
+    """
+    Candidate index terms on one page, in order of first appearance and deduplicated:
+    reference vocabulary matches, quoted titles and short title-case heading lines.
+    """
+    vocabulary_pattern = vocabulary_pattern or _vocabulary_pattern()
+    vocabulary = {collation_key(term): term for term in reference_vocabulary()}
+    terms = {}
+    for match in vocabulary_pattern.finditer(text):
+        key = collation_key(match.group(0))
+        terms.setdefault(key, vocabulary.get(key, match.group(0)))
+    for match in QUOTED_TITLE_PATTERN.finditer(text):
+        terms.setdefault(collation_key(match.group(1)), f"“{match.group(1).strip()}”")
+    for line in text.split("\n"):
+        if _is_heading_line(line):
+            terms.setdefault(collation_key(line), line.strip(" :"))
+    return [term for key, term in terms.items() if key]
+
+
+def build_term_index(pdf_text_with_pages):
+    """
+    Builds an inverted index of candidate terms over the pages.
+    Returns (term_index, page_terms): term_index maps collation_key(term) to
+    {"term": term, "pages": [page, ...]}, and page_terms maps each page to its terms.
+    """
+    vocabulary_pattern = _vocabulary_pattern()
+    term_index = {}
+    page_terms = {}
+    for item in pdf_text_with_pages:
+        terms = extract_page_terms(item["text"], vocabulary_pattern)
+        page_terms[item["page"]] = terms
+        for term in terms:
+            entry = term_index.setdefault(collation_key(term), {"term": term, "pages": []})
+            entry["pages"].append(item["page"])
+    return term_index, page_terms
+
+
+def build_page_digests(pdf_text_with_pages, page_terms):
+    """
+    Replaces each page's text with a compact digest listing its candidate terms, for
+    sending to the LLM instead of the full text. Pages without terms keep a short excerpt.
+    """
+    digests = []
     for item in pdf_text_with_pages:
-        page_content = f"--- Page {item['page']} ---\n{item['text']}\n\n"
-        if current_input_length + len(page_content) > MAX_LLM_INPUT_LENGTH:
-            truncated_input = True
+        terms = page_terms.get(item["page"])
+        text = f"Terms: {'; '.join(terms)}" if terms else item["text"][:200]
+        digests.append({"page": item["page"], "text": text})
+    return digests
+
+
+def validate_index_citations(root, term_index):
+    """
+    Checks the plain page citations of index entries whose heading is a locally indexed
+    term against the pages where that term actually occurs.
+    Returns (checked, mismatches); each mismatch lists the cited pages without an occurrence.
+    """
+    checked = 0
+    mismatches = []
+    for _, entry in root.walk():
+        found = term_index.get(collation_key(entry.heading))
+        cited = {page for unit, page in entry.pages if unit == 0}
+        if found is None or not cited:
+            continue
+        checked += 1
+        unsupported = sorted(cited - set(found["pages"]))
+        if unsupported:
+            mismatches.append({"heading": entry.heading, "unsupported_pages": unsupported, "found_on": found["pages"]})
+    return checked, mismatches
+
+
+# --- Prompt construction and token budgeting ---
+# Context window and safety margin of INDEX_MODEL_NAME, in tokens. The page budget for a
+# single request is what remains after the base prompt and the reserved output tokens.
+MODEL_CONTEXT_TOKENS = int(os.getenv("MODEL_CONTEXT_TOKENS", 200000))
+PROMPT_TOKEN_MARGIN = 1000
+# Packed pages are only counted with the model's tokenizer (a round trip that uploads the
+# whole text) when their estimated size exceeds this share of the budget.
+EXACT_COUNT_FRACTION = 0.75
+
+
+@st.cache_resource(show_spinner=False)
+def _base_prompt_token_counts():
+    # Process-wide {model name: token count}, so the base prompt is counted once, not per rerun.
+    return {}
+
+
+def _format_page_for_prompt(item):
+    return f"--- Page {item['page']} ---\n{item['text']}\n\n"
+
+
+def _estimate_tokens(text):
+    # Roughly four characters per token for English prose.
+    return len(text) // 4 + 1
+
+
+def count_tokens(chat_model, text):
+    """
+    Counts the input tokens of text as a user message using the model's own tokenizer
+    (Anthropic's token counting endpoint for ChatAnthropic). Falls back to an estimate
+    if the model cannot count tokens.
+    """
+    try:
+        return chat_model.get_num_tokens_from_messages([HumanMessage(content=text)])
+    except Exception:
+        return _estimate_tokens(text)
+
+
+def base_prompt_tokens(chat_model):
+    """Token count of INDEX_BASE_PROMPT, counted once per model."""
+    counts = _base_prompt_token_counts()
+    model_name = getattr(chat_model, "model", INDEX_MODEL_NAME)
+    if model_name not in counts:
+        counts[model_name] = count_tokens(chat_model, INDEX_BASE_PROMPT)
+    return counts[model_name]
+
+
+def pack_pages_to_token_budget(chat_model, pdf_text_with_pages, token_budget=None):
+    """
+    Selects the longest prefix of pages that fits a single request. The default budget is
+    the model's context window minus the base prompt, the reserved output tokens and a margin.
+    Pages are packed by estimate; only when the estimate comes close to the budget is the
+    packed text counted with the model's tokenizer and trimmed until it fits.
+    Returns (pages_to_send, truncated).
+    """
+    if token_budget is None:
+        token_budget = MODEL_CONTEXT_TOKENS - INDEX_MAX_TOKENS - base_prompt_tokens(chat_model) - PROMPT_TOKEN_MARGIN
+
+    selected, total = [], 0
+    for item in pdf_text_with_pages:
+        page_tokens = _estimate_tokens(_format_page_for_prompt(item))
+        if total + page_tokens > token_budget:
             break
-        pdf_content_to_send += page_content
-        current_input_length += len(page_content)
+        selected.append(item)
+        total += page_tokens
 
-    input_text += pdf_content_to_send
+    while selected and total > EXACT_COUNT_FRACTION * token_budget:
+        actual = count_tokens(chat_model, "".join(_format_page_for_prompt(item) for item in selected))
+        if actual <= token_budget:
+            break
+        keep = int(len(selected) * token_budget / actual)
+        selected = selected[:min(keep, len(selected) - 1)]
+
+    return selected, len(selected) < len(pdf_text_with_pages)
+
+
+def build_index_messages(page_text, cache_pages=False):
+    """
+    Builds the index request. The static base prompt is its own content block tagged for
+    Anthropic prompt caching, so repeated and chunked requests only pay for it once.
+    With cache_pages the page text is tagged too, for requests likely to need continuation rounds.
+    """
+    page_block = {"type": "text", "text": page_text}
+    if cache_pages:
+        page_block["cache_control"] = {"type": "ephemeral"}
+    return [HumanMessage(content=[
+        {"type": "text", "text": INDEX_BASE_PROMPT, "cache_control": {"type": "ephemeral"}},
+        page_block,
+    ])]
+
+
+def _message_text(message):
+    """Returns the text of a message or message chunk, whether its content is a string or content blocks."""
+    content = message.content
+    if isinstance(content, str):
+        return content
+    return "".join(
+        block if isinstance(block, str) else block.get("text", "")
+        for block in content
+        if isinstance(block, str) or block.get("type") == "text"
+    )
+
+
+def _record_request_stats(request_stats, label, response, started, first_line_at=None):
+    """Appends token usage and latency of one LLM request to request_stats (if given)."""
+    if request_stats is None:
+        return
+    usage = getattr(response, "usage_metadata", None) or {}
+    details = usage.get("input_token_details") or {}
+    stats = {
+        "request": label,
+        "input_tokens": usage.get("input_tokens", 0),
+        "cached_tokens": details.get("cache_read", 0),
+        "cache_write_tokens": details.get("cache_creation", 0),
+        "output_tokens": usage.get("output_tokens", 0),
+        "latency_s": round(time.perf_counter() - started, 2),
+    }
+    if first_line_at is not None:
+        stats["first_line_s"] = round(first_line_at - started, 2)
+    request_stats.append(stats)
+
+
+def _build_single_request(chat_model, pdf_text_with_pages):
+    """
+    Packs pages into one request up to the token budget, noting any truncation.
+    Returns (label, page_text).
+    """
+    pages_to_send, truncated_input = pack_pages_to_token_budget(chat_model, pdf_text_with_pages)
+    page_text = "".join(_format_page_for_prompt(item) for item in pages_to_send)
     if truncated_input:
-        input_text += "\n\n--- Content truncated due to length limits for LLM input. Index generated based on available content. ---"
+        page_text += "\n\n--- Content truncated due to length limits for LLM input. Index generated based on available content. ---"
+    label = f"pages {pages_to_send[0]['page']}-{pages_to_send[-1]['page']}" if pages_to_send else "index"
+    return label, page_text
+
+
+def generate_teacher_guide_index_with_llm(chat_model, pdf_text_with_pages, request_stats=None):
+    """
+    Sends extracted PDF text to the LLM with a prompt to generate a teacher guide index
+    mimicking the structure of 'SK17 G1 Index (1).pdf'.
+    Pages are packed up to the model's token budget; anything beyond it is dropped and noted.
+    Adds instructions for the LLM to indicate completion or truncation.
+    Token usage and latency are appended to request_stats if a list is passed.
+    """
+    if not chat_model:
+        return "LLM model not initialized."
+
+    label, page_text = _build_single_request(chat_model, pdf_text_with_pages)
+    continuation = IndexContinuation(build_index_messages(page_text, cache_pages=True))
 
     try:
-        messages = [HumanMessage(content=input_text)]
-        llm_response = chat_model.invoke(messages)
-        return llm_response.content
+        while True:
+            started = time.perf_counter()
+            llm_response = chat_model.invoke(continuation.messages)
+            _record_request_stats(request_stats, continuation.label(label), llm_response, started)
+            if not continuation.add_round(llm_response, _message_text(llm_response)):
+                break
     except Exception as e:
-        if 'st' in globals():
+        if _in_streamlit():
             st.error(f"Error interacting with LLM: {str(e)}")
         else:
             print(f"Error interacting with LLM: {str(e)}")
         return None
+    continuation.report()
+    return continuation.result_text()
+
+
+def _starts_continuation(line, resume_heading):
+    """
+    True if line can open a continuation round: the resumed entry's heading, an indented
+    line, or any line with page references or a cross-reference. Anything else is prose.
+    """
+    if not line.strip():
+        return False
+    if line[:1].isspace() or collation_key(line) == collation_key(resume_heading or ""):
+        return True
+    return IndexParser().feed_line(line) is not None
+
+
+def stream_index_lines(chat_model, pdf_text_with_pages, request_stats=None):
+    """
+    Streaming variant of generate_teacher_guide_index_with_llm: yields each line of the
+    index as soon as the model has finished producing it, continuing truncated responses
+    the same way. Lines of a truncated round that continuation supersedes (the partial
+    last line and the incomplete marker) are held back, as are the lines of the resumed
+    entry that an earlier round already yielded. Exceptions from the model are raised to
+    the caller. Usage stats (including time to the first line) are recorded as each round
+    ends. Returns the stitched index text (see IndexContinuation.result_text), which is
+    what should be kept once more than one round was needed.
+    """
+    label, page_text = _build_single_request(chat_model, pdf_text_with_pages)
+    continuation = IndexContinuation(build_index_messages(page_text, cache_pages=True))
+    # Lines yielded since the last top-level entry; the next round repeats that entry in full.
+    last_entry_lines = []
+
+    while True:
+        started = time.perf_counter()
+        first_line_at = None
+        response = None
+        round_text = ""
+        pending = ""
+        held_markers = []
+        already_yielded = set(last_entry_lines) if continuation.rounds else set()
+        in_resumed_entry = bool(already_yielded)
+        round_started = True
+        # Continuation rounds may open with a sentence before the resumed entry.
+        skipping_preamble = continuation.rounds > 0
+        for chunk in chat_model.stream(continuation.messages):
+            # Summing chunks accumulates usage metadata as well as content.
+            response = chunk if response is None else response + chunk
+            text = _message_text(chunk)
+            round_text += text
+            pending += text
+            *lines, pending = pending.split("\n")
+            for line in lines:
+                if line.strip() == INDEX_INCOMPLETE_MARKER:
+                    held_markers.append(line)
+                    continue
+                if skipping_preamble:
+                    if not _starts_continuation(line, continuation.resume_heading):
+                        continue
+                    skipping_preamble = False
+                top_level = bool(line[:1].strip())
+                if top_level and not round_started:
+                    in_resumed_entry = False
+                if line.strip():
+                    round_started = False
+                if in_resumed_entry and line.strip() in already_yielded:
+                    continue
+                if top_level:
+                    last_entry_lines = []
+                last_entry_lines.append(line.strip())
+                if first_line_at is None:
+                    first_line_at = time.perf_counter()
+                yield line
+        _record_request_stats(request_stats, continuation.label(label), response, started, first_line_at)
+        if not continuation.add_round(response, round_text):
+            break
+    if continuation.last_round_truncated:
+        # Out of rounds: drop the partial last line and flag the index as incomplete.
+        yield INDEX_INCOMPLETE_MARKER
+    else:
+        if pending:
+            yield pending
+        yield from held_markers
+    continuation.report()
+    return continuation.result_text()
+
+
+# --- Structured index model ---
+END_OF_INDEX_MARKER = "--- END OF INDEX ---"
+INDEX_INCOMPLETE_MARKER = "--- INDEX INCOMPLETE ---"
+
+PAGE_REF_PATTERN = re.compile(r"^(?:Pages?\s+)?(?:(\d+)/)?(\d+)(?:\s*[-–]\s*(?:\d+/)?(\d+))?$", re.IGNORECASE)
+# 'See X' / 'See also X' at the start of a line or after a separator, e.g.
+# 'Abbreviations, understand. See Vocabulary.' or 'Informal Assessment: See Daily Routines'.
+CROSS_REF_PATTERN = re.compile(r"(?:^|[.:;,]\s+|\s\()(See also|See)\s+(.+?)\)?\.?$")
+# Page references introduced by a comma instead of a colon, e.g. 'Vowels, Page 4, Page 9'.
+TRAILING_PAGES_PATTERN = re.compile(r",\s*(Pages?\s+\d.*)$", re.IGNORECASE)
+
+
+def _parse_page_refs(text):
+    """
+    Parses 'Page 4, Pages 6-8, 1/101' into a set of (unit, page) tuples (unit 0 when absent).
+    Returns None if the text is not purely a list of page references.
+    """
+    refs = set()
+    for part in text.rstrip(".").split(","):
+        match = PAGE_REF_PATTERN.match(part.strip())
+        if not match:
+            return None
+        unit = int(match.group(1) or 0)
+        first = int(match.group(2))
+        last = int(match.group(3) or first)
+        refs.update((unit, page) for page in range(first, max(first, last) + 1))
+    return refs
+
+
+def _ends_with_page_refs(text):
+    """True if text ends in page references, after a colon or a comma ('Game: Page 7')."""
+    head, sep, tail = text.rpartition(":")
+    if sep and tail.strip() and _parse_page_refs(tail) is not None:
+        return True
+    trailing = TRAILING_PAGES_PATTERN.search(text)
+    return bool(trailing) and _parse_page_refs(trailing.group(1)) is not None
+
+
+def _format_page_refs(refs):
+    """
+    Formats (unit, page) tuples as 'Page 4, Pages 6-8, 1/101-103', collapsing consecutive pages.
+    """
+    parts = []
+    ordered = sorted(refs)
+    i = 0
+    while i < len(ordered):
+        unit, first = ordered[i]
+        last = first
+        while i + 1 < len(ordered) and ordered[i + 1] == (unit, last + 1):
+            i += 1
+            last += 1
+        if unit:
+            parts.append(f"{unit}/{first}" if first == last else f"{unit}/{first}-{last}")
+        else:
+            parts.append(f"Page {first}" if first == last else f"Pages {first}-{last}")
+        i += 1
+    return ", ".join(parts)
+
+
+def collation_key(heading):
+    """
+    Case-folded sort and dedupe key for a heading, ignoring leading quotes and
+    trailing punctuation, so '“Fire!”' files under F and 'Phonics:' matches 'phonics'.
+    """
+    return " ".join(heading.strip("\"'“”‘’ .:,;").split()).casefold()
+
+
+class IndexEntry:
+    """
+    A heading in the index with its (unit, page) references, 'See'/'See also'
+    targets and sub-entries (keyed by collation_key). The root entry has an empty heading.
+    """
+    __slots__ = ("heading", "pages", "see", "see_also", "children")
+
+    def __init__(self, heading=""):
+        self.heading = heading
+        self.pages = set()
+        self.see = []
+        self.see_also = []
+        self.children = {}
+
+    def child(self, heading):
+        """Returns the sub-entry for heading, creating it if needed."""
+        key = collation_key(heading)
+        entry = self.children.get(key)
+        if entry is None:
+            entry = self.children[key] = IndexEntry(heading)
+        return entry
+
+    def add_cross_refs(self, kind, targets):
+        existing = self.see if kind == "See" else self.see_also
+        known = {collation_key(target) for target in existing}
+        for target in targets:
+            key = collation_key(target)
+            if key and key not in known and key != collation_key(self.heading):
+                existing.append(target)
+                known.add(key)
+
+    def merge(self, other):
+        """Merges another entry (and its whole subtree) into this one."""
+        self.pages |= other.pages
+        self.add_cross_refs("See", other.see)
+        self.add_cross_refs("See also", other.see_also)
+        for key, entry in other.children.items():
+            target = self.children.get(key)
+            if target is None:
+                self.children[key] = target = IndexEntry(entry.heading)
+            target.merge(entry)
+
+    def sorted_children(self):
+        return sorted(self.children.values(), key=lambda entry: collation_key(entry.heading))
+
+    def walk(self, depth=0):
+        """Yields (depth, entry) for every sub-entry in alphabetical order, depth-first."""
+        for entry in self.sorted_children():
+            yield depth, entry
+            yield from entry.walk(depth + 1)
+
+    def to_dict(self):
+        """JSON-serialisable form of this entry and its sub-entries; pages are [unit, page] pairs."""
+        return {
+            "heading": self.heading,
+            "pages": [list(ref) for ref in sorted(self.pages)],
+            "see": list(self.see),
+            "see_also": list(self.see_also),
+            "children": [entry.to_dict() for entry in self.sorted_children()],
+        }
+
+    def format_line(self):
+        """Formats this entry's own line, without indentation."""
+        line = self.heading
+        if self.pages:
+            line += f": {_format_page_refs(self.pages)}"
+        elif self.children and not self.see:
+            line += ":"
+        if self.see:
+            line += f". See {'; '.join(self.see)}."
+        if self.see_also:
+            line += f"{'' if self.see else '.'} See also {'; '.join(self.see_also)}."
+        return line
+
+
+class IndexParser:
+    """
+    Incremental, linear-time parser from LLM index text to an IndexEntry tree.
+    Lines may be fed one at a time (e.g. while streaming); nesting follows indentation,
+    whatever indent width the model used. Tracks the completion markers as they appear.
+    A line without page references or cross-references only becomes an entry once a
+    sub-entry is nested under it; otherwise it is prose (a preamble such as 'Here is the
+    index:', a letter divider, a closing remark) and is skipped.
+    """
+    __slots__ = ("root", "complete", "incomplete", "_stack", "_last", "_pending")
+
+    def __init__(self):
+        self.root = IndexEntry()
+        self.complete = False
+        self.incomplete = False
+        self._stack = [(-1, self.root)]
+        self._last = None
+        # (indent, heading) of the last bare line, until a sub-entry shows it is a heading.
+        self._pending = None
+
+    def feed(self, text):
+        for line in text.split("\n"):
+            self.feed_line(line)
+        return self
+
+    def feed_line(self, line):
+        """Parses one line; returns the IndexEntry it created or updated, if any."""
+        stripped = line.strip()
+        if stripped == END_OF_INDEX_MARKER:
+            self.complete = True
+            return None
+        if stripped == INDEX_INCOMPLETE_MARKER:
+            self.incomplete = True
+            return None
+        if not stripped or stripped.startswith("---"):
+            return None
+
+        indent = len(line) - len(line.lstrip())
+        text = stripped.lstrip("-*• ").strip()
+
+        kind, targets = None, []
+        match = CROSS_REF_PATTERN.search(text)
+        if match and _ends_with_page_refs(match.group(2)):
+            # Cross-references never carry pages: 'See and Say Game: Page 7' is a heading.
+            match = None
+        if match:
+            kind = match.group(1)
+            targets = [target.strip() for target in match.group(2).split(";") if target.strip()]
+            text = text[:match.start()].strip()
+            if not text:
+                # A cross-reference on its own line belongs to the entry above it.
+                entry = self._attach(*self._pending) if self._pending else self._last
+                self._pending = None
+                if entry is not None:
+                    entry.add_cross_refs(kind, targets)
+                return entry
+
+        heading, pages = text.rstrip(".:"), set()
+        head, sep, tail = text.rpartition(":")
+        refs = _parse_page_refs(tail) if sep and tail.strip() else None
+        if refs is not None:
+            heading, pages = head.strip(), refs
+        else:
+            trailing = TRAILING_PAGES_PATTERN.search(text)
+            refs = _parse_page_refs(trailing.group(1)) if trailing else None
+            if refs is not None:
+                heading, pages = text[:trailing.start()].strip(), refs
+        heading = heading.rstrip(".:,; ")
+        if not heading:
+            return None
+
+        if self._pending is not None and indent > self._pending[0]:
+            self._attach(*self._pending)
+        self._pending = None
+        if not pages and not kind:
+            self._pending = (indent, heading)
+            return None
+        entry = self._attach(indent, heading)
+        entry.pages |= pages
+        if kind:
+            entry.add_cross_refs(kind, targets)
+        return entry
+
+    def _attach(self, indent, heading):
+        while self._stack[-1][0] >= indent:
+            self._stack.pop()
+        entry = self._stack[-1][1].child(heading)
+        self._stack.append((indent, entry))
+        self._last = entry
+        return entry
+
+
+def parse_index_text(text):
+    """Parses complete LLM index text; returns the IndexParser holding the tree and marker flags."""
+    return IndexParser().feed(text)
+
+
+def render_index_text(root, complete=True):
+    """
+    Renders an IndexEntry tree back to index text (two-space indent per level),
+    terminated by the end-of-index or incomplete marker.
+    """
+    lines = [f"{'  ' * depth}{entry.format_line()}" for depth, entry in root.walk()]
+    lines.append(END_OF_INDEX_MARKER if complete else INDEX_INCOMPLETE_MARKER)
+    return "\n".join(lines)
+
+
+# --- Continuation of truncated responses ---
+# Maximum number of requests (the first plus continuations) spent on one index.
+MAX_INDEX_ROUNDS = int(os.getenv("MAX_INDEX_ROUNDS", 4))
+
+CONTINUE_PROMPT = "Your previous response was cut off before the index was finished. " \
+                  "Continue the index starting with the entry '{heading}' (repeat that entry in full, " \
+                  "including all of its sub-entries), then every entry after it in alphabetical order. " \
+                  "Do not repeat any earlier entries. Reply with index lines only, with no introduction " \
+                  "or commentary. Follow exactly the same format, and end with " \
+                  "'--- END OF INDEX ---' once the index is complete."
+
+
+class IndexContinuation:
+    """
+    Tracks the rounds of one index request whose response may be truncated by max_tokens.
+    Each round's complete lines are parsed and merged into a single IndexEntry tree, so a
+    heading repeated at the resume point is not duplicated. When a round stops at
+    max_tokens or reports the incomplete marker, `messages` becomes a continuation
+    request: the original prompt, the truncated answer as an AIMessage, and a request to
+    resume from the last complete top-level heading.
+    """
+    __slots__ = ("base_messages", "messages", "merged", "rounds", "output_tokens",
+                 "last_round_truncated", "complete", "_single_round_text", "resume_heading")
+
+    def __init__(self, messages):
+        self.base_messages = messages
+        self.messages = messages
+        self.merged = IndexEntry()
+        self.rounds = 0
+        self.output_tokens = 0
+        self.last_round_truncated = False
+        self.complete = False
+        self._single_round_text = None
+        # Top-level heading the pending continuation request resumes from.
+        self.resume_heading = None
+
+    def label(self, label):
+        """Labels the upcoming request for request_stats."""
+        return label if self.rounds == 0 else f"{label} (continuation {self.rounds})"
+
+    def add_round(self, response, text):
+        """
+        Records one round's response. Returns True if another round should be requested.
+        """
+        self.rounds += 1
+        self.output_tokens += (getattr(response, "usage_metadata", None) or {}).get("output_tokens", 0)
+        stop_reason = (getattr(response, "response_metadata", None) or {}).get("stop_reason")
+        truncated = stop_reason == "max_tokens" or (
+            INDEX_INCOMPLETE_MARKER in text and END_OF_INDEX_MARKER not in text
+        )
+        self.last_round_truncated = truncated
+
+        lines = text.split("\n")
+        if truncated and stop_reason == "max_tokens" and not text.endswith("\n"):
+            # The last line was cut off mid-entry; the next round repeats it.
+            lines = lines[:-1]
+        parser = IndexParser()
+        for line in lines:
+            if not (truncated and line.strip() == INDEX_INCOMPLETE_MARKER):
+                parser.feed_line(line)
+        self.merged.merge(parser.root)
+        self.complete = parser.complete and not truncated
+        if self.rounds == 1:
+            self._single_round_text = text
+
+        if not truncated or self.rounds >= MAX_INDEX_ROUNDS or not parser.root.children:
+            return False
+        resume_heading = next(reversed(parser.root.children.values())).heading
+        if resume_heading == self.resume_heading:
+            # The previous continuation made no progress; further rounds would not either.
+            return False
+        self.resume_heading = resume_heading
+        self.messages = self.base_messages + [
+            AIMessage(content=text.rstrip()),
+            HumanMessage(content=CONTINUE_PROMPT.format(heading=resume_heading)),
+        ]
+        return True
+
+    def result_text(self):
+        """
+        The stitched index text. A single untruncated round is returned exactly as the model
+        wrote it; otherwise the merged tree is rendered, ending with the incomplete marker
+        if the round limit was reached first.
+        """
+        if self.rounds == 1 and not self.last_round_truncated:
+            return self._single_round_text
+        return render_index_text(self.merged, self.complete)
+
+    def report(self):
+        """Reports rounds and output tokens when continuation was needed."""
+        if self.rounds <= 1:
+            return
+        message = f"Index generated in {self.rounds} rounds ({self.output_tokens} output tokens)."
+        if self.last_round_truncated:
+            message += f" Stopped after the {MAX_INDEX_ROUNDS}-round limit; the index may be incomplete."
+        if _in_streamlit():
+            st.info(message)
+        else:
+            print(message)
+
+
+# --- Map-reduce index generation over page chunks ---
+# Approximate input-token budget per chunk. Each chunk's partial index must also fit in
+# INDEX_MAX_TOKENS of output, so chunks are kept well below the model's context window.
+CHUNK_TOKEN_BUDGET = int(os.getenv("CHUNK_TOKEN_BUDGET", 20000))
+# Maximum number of chunk requests in flight at once.
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", 4))
+# Retries for rate-limited, overloaded or failed requests, and the base backoff in seconds.
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 5))
+LLM_BACKOFF_SECONDS = 2.0
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504, 529}
+
+
+def chunk_pages_by_token_budget(pdf_text_with_pages, token_budget=CHUNK_TOKEN_BUDGET):
+    """
+    Splits page records into consecutive chunks whose formatted text stays within
+    token_budget. A single page larger than the budget becomes a chunk of its own.
+    """
+    chunks = []
+    current, current_tokens = [], 0
+    for item in pdf_text_with_pages:
+        page_tokens = _estimate_tokens(_format_page_for_prompt(item))
+        if current and current_tokens + page_tokens > token_budget:
+            chunks.append(current)
+            current, current_tokens = [], 0
+        current.append(item)
+        current_tokens += page_tokens
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def merge_partial_indexes(partial_indexes):
+    """
+    Deterministically merges partial index texts: headings and sub-entries are unioned
+    (case-insensitively), page lists merged and range-collapsed, and entries sorted
+    alphabetically. Ends with the end-of-index marker only if every partial was complete.
+    """
+    merged = IndexEntry()
+    complete = True
+    for text in partial_indexes:
+        parsed = parse_index_text(text)
+        complete = complete and parsed.complete and not parsed.incomplete
+        merged.merge(parsed.root)
+    return render_index_text(merged, complete)
+
+
+def _retry_delay(error, attempt):
+    """
+    Seconds to wait before retrying a failed LLM request, or None if the error is not
+    transient. Honours the server's Retry-After header, otherwise backs off exponentially
+    with jitter. This is the only retry policy for map-reduce requests, so the client
+    should be created with max_retries=0.
+    """
+    import anthropic
+
+    if isinstance(error, anthropic.APIStatusError):
+        if error.status_code not in RETRYABLE_STATUS_CODES:
+            return None
+    elif not isinstance(error, anthropic.APIConnectionError):  # includes APITimeoutError
+        return None
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    return LLM_BACKOFF_SECONDS * 2 ** attempt * random.uniform(0.5, 1.0)
+
+
+async def _ainvoke_with_retry(chat_model, messages):
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        try:
+            return await chat_model.ainvoke(messages)
+        except Exception as e:
+            delay = _retry_delay(e, attempt)
+            if delay is None or attempt == LLM_MAX_RETRIES:
+                raise
+            await asyncio.sleep(delay)
+
+
+async def _generate_partial_index(chat_model, chunk, semaphore, request_stats=None):
+    async with semaphore:
+        page_text = "".join(_format_page_for_prompt(item) for item in chunk)
+        label = f"pages {chunk[0]['page']}-{chunk[-1]['page']}"
+        continuation = IndexContinuation(build_index_messages(page_text))
+        while True:
+            started = time.perf_counter()
+            response = await _ainvoke_with_retry(chat_model, continuation.messages)
+            _record_request_stats(request_stats, continuation.label(label), response, started)
+            if not continuation.add_round(response, _message_text(response)):
+                break
+        return continuation.result_text()
+
+
+async def agenerate_teacher_guide_index_map_reduce(chat_model, pdf_text_with_pages, token_budget=CHUNK_TOKEN_BUDGET,
+                                                   concurrency=LLM_CONCURRENCY, request_stats=None, semaphore=None):
+    """
+    Async form of generate_teacher_guide_index_map_reduce. Pass a shared `semaphore` to
+    bound LLM requests across several documents indexed at once.
+    """
+    if not chat_model:
+        return "LLM model not initialized."
+
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(concurrency)
+    chunks = chunk_pages_by_token_budget(pdf_text_with_pages, token_budget)
+    results = await asyncio.gather(
+        *(_generate_partial_index(chat_model, chunk, semaphore, request_stats) for chunk in chunks),
+        return_exceptions=True
+    )
+
+    partial_indexes = []
+    for chunk, result in zip(chunks, results):
+        if isinstance(result, Exception):
+            message = f"Error interacting with LLM for pages {chunk[0]['page']}-{chunk[-1]['page']}: {str(result)}"
+            if _in_streamlit():
+                st.error(message)
+            else:
+                print(message)
+            # Marks the merged index as incomplete.
+            partial_indexes.append(INDEX_INCOMPLETE_MARKER)
+        else:
+            partial_indexes.append(result)
+
+    if all(isinstance(result, Exception) for result in results):
+        return None
+    return merge_partial_indexes(partial_indexes)
+
+
+def generate_teacher_guide_index_map_reduce(chat_model, pdf_text_with_pages, token_budget=CHUNK_TOKEN_BUDGET,
+                                            concurrency=LLM_CONCURRENCY, request_stats=None):
+    """
+    Map-reduce variant of generate_teacher_guide_index_with_llm for large documents.
+    Pages are split into token-budgeted chunks, a partial index is generated for each
+    chunk concurrently (at most `concurrency` requests in flight, retrying rate-limited
+    requests with backoff), and the partials are merged in Python rather than by another
+    LLM pass, so there is no overall size ceiling.
+    Token usage and latency of each chunk request are appended to request_stats if given.
+    """
+    return asyncio.run(agenerate_teacher_guide_index_map_reduce(
+        chat_model, pdf_text_with_pages, token_budget, concurrency, request_stats
+    ))
+
+
+# --- Content-addressed extraction and index cache ---
+INDEX_CACHE_PATH = os.getenv("INDEX_CACHE_PATH", ".teacher_index_cache.sqlite3")
+INDEX_CACHE_MAX_BYTES = int(os.getenv("INDEX_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+
+
+def pdf_content_hash(pdf_bytes):
+    """
+    Returns the SHA-256 hex digest of the raw PDF bytes (bytes or memoryview).
+    """
+    return hashlib.sha256(pdf_bytes).hexdigest()
+
+
+def index_fingerprint(mode="single"):
+    """
+    Fingerprint of everything other than the PDF that shapes the generated index:
+    the prompt, the model and its output limit, the continuation round limit, and the
+    generation mode (optionally '+digests') with its input budget and the preprocessing
+    version. Changing any of them invalidates cached indexes.
+    """
+    parts = [INDEX_BASE_PROMPT, INDEX_MODEL_NAME, str(INDEX_MAX_TOKENS), str(MAX_INDEX_ROUNDS), mode,
+             str(PREPROCESS_VERSION)]
+    if mode.startswith("map_reduce"):
+        parts.append(str(CHUNK_TOKEN_BUDGET))
+    else:
+        parts.append(str(MODEL_CONTEXT_TOKENS))
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()[:16]
+
+
+class IndexCache:
+    """
+    On-disk SQLite cache for extracted page text and LLM-generated indexes.
+    Values are stored as zlib-compressed JSON, keyed by the PDF hash (plus the index
+    fingerprint for indexes), and evicted least-recently-used once the total stored size
+    exceeds max_bytes. Hit/miss counters live in the same database so they survive reruns.
+    """
+
+    def __init__(self, path=INDEX_CACHE_PATH, max_bytes=INDEX_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, data BLOB NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)")
+            conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _report(message):
+        if _in_streamlit():
+            st.warning(message)
+        else:
+            print(f"Warning: {message}")
+
+    def _get(self, kind, key):
+        try:
+            with self._connect() as conn:
+                row = conn.execute("SELECT data FROM entries WHERE key = ?", (key,)).fetchone()
+                counter = f"{kind}_hits" if row else f"{kind}_misses"
+                conn.execute(
+                    "INSERT INTO counters (name, value) VALUES (?, 1) "
+                    "ON CONFLICT(name) DO UPDATE SET value = value + 1",
+                    (counter,)
+                )
+                if row is None:
+                    return None
+                conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+            return json.loads(zlib.decompress(row[0]).decode("utf-8"))
+        except (sqlite3.Error, zlib.error, ValueError) as e:
+            self._report(f"Index cache read failed, continuing without cache: {str(e)}")
+            return None
+
+    def _put(self, key, value):
+        data = zlib.compress(json.dumps(value, ensure_ascii=False).encode("utf-8"))
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO entries (key, data, size, last_access) VALUES (?, ?, ?, ?)",
+                    (key, data, len(data), time.time())
+                )
+                self._evict(conn)
+        except sqlite3.Error as e:
+            self._report(f"Index cache write failed: {str(e)}")
+
+    def _evict(self, conn):
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in conn.execute("SELECT key, size FROM entries ORDER BY last_access").fetchall():
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def get_pages(self, pdf_hash):
+        """Returns cached [{"page": n, "text": "..."}] records for a PDF, or None."""
+        return self._get("pages", f"pages:{pdf_hash}")
+
+    def put_pages(self, pdf_hash, pages_content):
+        self._put(f"pages:{pdf_hash}", pages_content)
+
+    def get_index(self, pdf_hash, mode="single"):
+        """Returns the cached LLM index text for a PDF under the current fingerprint, or None."""
+        return self._get("index", f"index:{pdf_hash}:{index_fingerprint(mode)}")
+
+    def put_index(self, pdf_hash, index_text, mode="single"):
+        self._put(f"index:{pdf_hash}:{index_fingerprint(mode)}", index_text)
+
+    def stats(self):
+        """Returns hit/miss counters plus the current entry count and stored size in bytes."""
+        with self._connect() as conn:
+            stats = dict(conn.execute("SELECT name, value FROM counters").fetchall())
+            entries, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        stats.update(entries=entries, bytes=size)
+        return stats
+
+
+@st.cache_resource(show_spinner=False)
+def shared_index_cache():
+    """The process-wide IndexCache at INDEX_CACHE_PATH, created once rather than per rerun."""
+    return IndexCache()
+
+
+# --- Pipeline instrumentation ---
+# Optional JSON-lines file that every pipeline metrics event is appended to.
+METRICS_LOG_PATH = os.getenv("METRICS_LOG_PATH")
+# Seconds between resident-memory samples while a stage runs.
+RSS_SAMPLE_SECONDS = 0.02
+
+
+def current_rss_bytes():
+    """
+    Resident set size of this process in bytes. Reads /proc on Linux; elsewhere falls back
+    to the peak RSS reported by the resource module (0 if that is unavailable too).
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class _RssSampler(threading.Thread):
+    """Background thread tracking peak RSS until stopped."""
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.peak = current_rss_bytes()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(RSS_SAMPLE_SECONDS):
+            self.peak = max(self.peak, current_rss_bytes())
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.peak = max(self.peak, current_rss_bytes())
+        return self.peak
+
+
+class PipelineMetrics:
+    """
+    Collects one structured event per pipeline stage: wall time, RSS at start and end,
+    peak RSS sampled while the stage ran, and any fields the stage adds (page counts,
+    token usage). Events are kept in `events` and appended to METRICS_LOG_PATH if set.
+    Peak RSS covers this process only, not extraction worker processes.
+    """
+
+    def __init__(self, run_id=None, log_path=METRICS_LOG_PATH):
+        self.run_id = run_id or f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}"
+        self.log_path = log_path
+        self.events = []
+
+    @contextmanager
+    def stage(self, name, **fields):
+        """
+        Measures the enclosed block as stage `name`. Yields the event dict, to which the
+        block can add fields such as {"pages": 412}.
+        """
+        event = {"run_id": self.run_id, "stage": name, **fields}
+        sampler = _RssSampler()
+        event["rss_start_mb"] = round(sampler.peak / 2 ** 20, 1)
+        sampler.start()
+        started = time.perf_counter()
+        event["status"] = "ok"
+        try:
+            yield event
+        except Exception as e:
+            event.update(status="error", error=str(e))
+            raise
+        finally:
+            event["seconds"] = round(time.perf_counter() - started, 3)
+            event["rss_peak_mb"] = round(sampler.stop() / 2 ** 20, 1)
+            event["rss_end_mb"] = round(current_rss_bytes() / 2 ** 20, 1)
+            if event.get("pages") and event["seconds"]:
+                event["pages_per_second"] = round(event["pages"] / event["seconds"], 2)
+            self.emit(event)
+
+    def emit(self, event):
+        self.events.append(event)
+        if not self.log_path:
+            return
+        # Called from stage()'s finally block: a failed log write must not mask the stage's own error.
+        try:
+            with open(self.log_path, "a", encoding="utf-8") as log:
+                log.write(json.dumps(event) + "\n")
+        except OSError as e:
+            if _in_streamlit():
+                st.warning(f"Could not write pipeline metrics to {self.log_path}: {str(e)}")
+            else:
+                print(f"Warning: Could not write pipeline metrics to {self.log_path}: {str(e)}")
+
+
+def summarize_request_stats(request_stats):
+    """Totals of LLM request stats, for attaching to a 'generate' stage event."""
+    return {
+        "requests": len(request_stats),
+        "input_tokens": sum(r["input_tokens"] for r in request_stats),
+        "cached_tokens": sum(r["cached_tokens"] for r in request_stats),
+        "output_tokens": sum(r["output_tokens"] for r in request_stats),
+    }
+
 
 # --- 4. PDF Generation from LLM Output ---
-def create_pdf_from_text(text_content, output_pdf_path="teacher_guide_index.pdf"):
+# Nesting levels with their own indent; deeper entries share the deepest style.
+INDEX_STYLE_LEVELS = 6
+
+
+@st.cache_resource(show_spinner=False)
+def _index_paragraph_styles():
+    """
+    Builds the title style and one index style per nesting level once per process;
+    ReportLab styles are read-only during rendering, so they are shared across calls.
+    """
+    from reportlab.lib.enums import TA_LEFT
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+
+    styles = getSampleStyleSheet()
+
+    # Define a custom style for the index content
+    index_style = ParagraphStyle(
+        'IndexStyle',
+        parent=styles['Normal'],
+        fontSize=10,
+        leading=12,
+        alignment=TA_LEFT,
+        leftIndent=0 # Default for main entries
+    )
+    # One style per nesting level, indented 20pt further than its parent
+    level_styles = [index_style] + [
+        ParagraphStyle(f'IndexLevel{depth}Style', parent=index_style, leftIndent=20 * depth)
+        for depth in range(1, INDEX_STYLE_LEVELS)
+    ]
+    return styles['h1'], level_styles
+
+
+def create_pdf_from_text(text_content, output_pdf_path="teacher_guide_index.pdf", parsed=None):
     """
     Creates a basic PDF document from a given string content.
-    The function already processes the LLM's output line by line, which can be seen
-    as a form of chunking for presentation.
+    The LLM's output is parsed into an IndexEntry tree first, so every nesting level
+    (e.g. Phonics > Long Vowels > ai/ay) and cross-reference is laid out consistently.
+    Pass an IndexParser that has already consumed text_content as `parsed` to skip reparsing.
+    output_pdf_path may also be a writable binary file object such as io.BytesIO, so the
+    PDF can be rendered in memory; it is returned on success.
     """
+    output_name = output_pdf_path if isinstance(output_pdf_path, str) else "in-memory buffer"
     try:
-        doc = SimpleDocTemplate(output_pdf_path, pagesize=letter)
-        styles = getSampleStyleSheet()
-
-        # Define a custom style for the index content
-        index_style = ParagraphStyle(
-            'IndexStyle',
-            parent=styles['Normal'],
-            fontSize=10,
-            leading=12,
-            alignment=TA_LEFT,
-            leftIndent=0 # Default for main entries
-        )
+        if parsed is None:
+            parsed = parse_index_text(text_content)
 
-        # A simple way to handle indentation for sub-entries based on leading spaces
-        sub_entry_style = ParagraphStyle(
-            'SubEntryStyle',
-            parent=index_style,
-            leftIndent=20 # Indent for sub-entries
-        )
+        from reportlab.lib.pagesizes import letter
+        from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
+
+        doc = SimpleDocTemplate(output_pdf_path, pagesize=letter)
+        title_style, level_styles = _index_paragraph_styles()
 
         flowables = []
-        flowables.append(Paragraph("Teacher's Guide Index Generated by LLM", styles['h1']))
+        flowables.append(Paragraph("Teacher's Guide Index Generated by LLM", title_style))
         flowables.append(Spacer(1, 0.2 * 2.54 * 72)) # 0.2 inch spacer
 
         # Check for LLM self-reported truncation
         llm_truncated_flag = False
-        if "--- INDEX INCOMPLETE ---" in text_content:
+        if parsed.incomplete:
             llm_truncated_flag = True
-            st.warning("The LLM indicated that the index generation was incomplete due to length constraints. The generated PDF will contain the partial index.")
-        elif "--- END OF INDEX ---" not in text_content:
-            st.warning("The LLM did not include the '--- END OF INDEX ---' marker. The response might have been truncated by the LLM or ended prematurely.")
-
-        # Split the text content into lines and apply basic styling
-        for line in text_content.split('\n'):
-            # Stop processing if we hit the LLM's explicit end marker
-            if line.strip() == "--- END OF INDEX ---":
-                break
-            if line.strip() == "":
-                flowables.append(Spacer(1, 0.1 * 2.54 * 72)) # Small spacer for empty lines
-            elif line.startswith("   - ") or line.startswith("     "): # Simple check for indentation
-                # Adjust for potentially malformed indentation if LLM is inconsistent
-                clean_line = line.lstrip(' ').lstrip('- ').strip()
-                flowables.append(Paragraph(clean_line, sub_entry_style))
+            message = "The LLM indicated that the index generation was incomplete due to length constraints. The generated PDF will contain the partial index."
+            if _in_streamlit():
+                st.warning(message)
+            else:
+                print(f"Warning: {message}")
+        elif not parsed.complete:
+            message = "The LLM did not include the '--- END OF INDEX ---' marker. The response might have been truncated by the LLM or ended prematurely."
+            if _in_streamlit():
+                st.warning(message)
             else:
-                flowables.append(Paragraph(line.strip(), index_style))
+                print(f"Warning: {message}")
+
+        current_letter = None
+        for depth, entry in parsed.root.walk():
+            if depth == 0:
+                letter_group = collation_key(entry.heading)[:1]
+                if current_letter is not None and letter_group != current_letter:
+                    flowables.append(Spacer(1, 0.1 * 2.54 * 72)) # Small spacer between letter groups
+                current_letter = letter_group
+            flowables.append(Paragraph(escape(entry.format_line()), level_styles[min(depth, len(level_styles) - 1)]))
 
         doc.build(flowables)
-        if 'st' in globals():
-            st.success(f"Successfully created PDF: {output_pdf_path}")
+        if _in_streamlit():
+            st.success(f"Successfully created PDF: {output_name}")
             if llm_truncated_flag:
                 st.info("Please review the generated PDF for completeness, as the LLM reported an incomplete index.")
         else:
-            print(f"Successfully created PDF: {output_pdf_path}")
+            print(f"Successfully created PDF: {output_name}")
             if llm_truncated_flag:
                 print("Please review the generated PDF for completeness, as the LLM reported an incomplete index.")
         return output_pdf_path
     except Exception as e:
-        if 'st' in globals():
+        if _in_streamlit():
             st.error(f"Error creating PDF: {str(e)}")
         else:
             print(f"Error creating PDF: {str(e)}")
@@ -254,59 +1575,465 @@ def create_pdf_from_text(text_content, output_pdf_path="teacher_guide_index.pdf"
 # --- 5. Main Execution Flow (Streamlit App or standalone script) ---
 
 # --- For Streamlit App ---
+# Number of most recent index lines kept in the live preview while streaming.
+PREVIEW_LINES = 200
+# Minimum seconds between preview redraws, so fast streams do not flood the browser.
+PREVIEW_REFRESH_SECONDS = 0.1
+# Most recently used extracted documents kept in each session's state for instant reruns.
+SESSION_EXTRACTION_LIMIT = 3
+
+
+def _stream_status(parser, entry_count):
+    if parser.incomplete:
+        return f"LLM reported an incomplete index after {entry_count} entries."
+    if parser.complete:
+        return f"Received the complete index: {entry_count} entries."
+    return f"Receiving index... {entry_count} entries so far"
+
+
+def stream_index_to_streamlit(chat_model, pdf_text_with_pages, request_stats=None):
+    """
+    Streams the index from the LLM into a live Streamlit preview of the most recent lines,
+    parsing entries as they complete. Completion markers are reported as soon as they arrive.
+    When continuation rounds were needed, the stitched index replaces the streamed lines.
+    Returns (index_text, parser), or (None, None) on error.
+    """
+    parser = IndexParser()
+    lines = []
+    preview_lines = deque(maxlen=PREVIEW_LINES)
+    status = st.empty()
+    preview = st.empty()
+    last_render = 0.0
+    entry_count = 0
+
+    index_lines = stream_index_lines(chat_model, pdf_text_with_pages, request_stats)
+    try:
+        while True:
+            try:
+                line = next(index_lines)
+            except StopIteration as stop:
+                index_text = stop.value
+                break
+            lines.append(line)
+            preview_lines.append(line)
+            if parser.feed_line(line) is not None:
+                entry_count += 1
+            now = time.perf_counter()
+            # Markers are shown immediately; regular lines at most every PREVIEW_REFRESH_SECONDS.
+            if parser.complete or parser.incomplete or now - last_render >= PREVIEW_REFRESH_SECONDS:
+                status.caption(_stream_status(parser, entry_count))
+                preview.code("\n".join(preview_lines), language='text')
+                last_render = now
+    except Exception as e:
+        st.error(f"Error interacting with LLM: {str(e)}")
+        return None, None
+
+    status.caption(_stream_status(parser, entry_count))
+    preview.code("\n".join(preview_lines), language='text')
+    if index_text.strip() != "\n".join(lines).strip():
+        # Stitched from several rounds: keep the merged index, not the raw stream.
+        parser = parse_index_text(index_text)
+    return index_text, parser
+
+
 def run_streamlit_app():
     st.title("PDF to LLM-Generated Teacher Guide Index")
 
     # File uploader
     uploaded_file = st.file_uploader("Upload a PDF file", type="pdf")
+    use_map_reduce = st.checkbox(
+        "Index page chunks concurrently and merge (recommended for large books)", value=False
+    )
+    use_digests = st.checkbox(
+        "Send compact per-page term digests instead of full page text (fewer tokens, less context)", value=False
+    )
 
     if uploaded_file is not None:
-        # Save uploaded file to a temporary path
-        temp_pdf_path = os.path.join("temp_uploaded_pdf.pdf")
-        with open(temp_pdf_path, "wb") as f:
-            f.write(uploaded_file.getbuffer())
+        # The upload is processed from memory; nothing is written to the shared working directory
+        pdf_buffer = uploaded_file.getbuffer()
 
         st.write(f"Processing '{uploaded_file.name}'...")
 
-        # Initialize LLM
-        chat_model = initialize_chat_model()
+        metrics = PipelineMetrics()
+        cache = shared_index_cache()
+        # Hashing a large upload on every rerun adds up, so the hash is memoised per upload.
+        upload_hashes = st.session_state.setdefault("upload_hashes", {})
+        if not uploaded_file.file_id:
+            pdf_hash = pdf_content_hash(pdf_buffer)
+        else:
+            if uploaded_file.file_id not in upload_hashes:
+                upload_hashes[uploaded_file.file_id] = pdf_content_hash(pdf_buffer)
+            pdf_hash = upload_hashes[uploaded_file.file_id]
+        mode = ("map_reduce" if use_map_reduce else "single") + ("+digests" if use_digests else "")
 
-        if chat_model:
-            st.info("Extracting text from PDF...")
-            pdf_text_data = extract_text_with_page_numbers(temp_pdf_path)
+        llm_index_content = cache.get_index(pdf_hash, mode)
+        # Set when the index was streamed: already previewed and parsed line by line.
+        parsed_index = None
+        term_index = None
+        if llm_index_content:
+            st.success("Found a cached index for this PDF. Skipping extraction and LLM.")
+        else:
+            # Initialize LLM
+            # Map-reduce retries failed chunk requests itself (see _retry_delay)
+            chat_model = initialize_chat_model(max_retries=0 if use_map_reduce else SDK_MAX_RETRIES)
 
-            if pdf_text_data:
-                st.success("Text extracted. Sending to LLM...")
+            if chat_model:
+                # Extraction results memoised in this session, then the shared on-disk cache
+                session_pages = st.session_state.setdefault("extracted_pages", {})
+                pdf_text_data = session_pages.get(pdf_hash) or cache.get_pages(pdf_hash)
+                if pdf_text_data:
+                    st.info("Using cached text extraction for this PDF.")
+                else:
+                    st.info("Extracting text from PDF...")
+                    with metrics.stage("extract", bytes=len(pdf_buffer)) as event, \
+                            spooled_pdf_source(pdf_buffer) as pdf_source:
+                        pdf_text_data = extract_text_with_page_numbers(pdf_source)
+                        event["pages"] = len(pdf_text_data or [])
+                    if pdf_text_data:
+                        cache.put_pages(pdf_hash, pdf_text_data)
+                if pdf_text_data:
+                    # Re-inserted so the most recently used documents are the ones kept.
+                    session_pages.pop(pdf_hash, None)
+                    session_pages[pdf_hash] = pdf_text_data
+                    while len(session_pages) > SESSION_EXTRACTION_LIMIT:
+                        session_pages.pop(next(iter(session_pages)))
 
-                llm_index_content = generate_teacher_guide_index_with_llm(chat_model, pdf_text_data)
+                if pdf_text_data:
+                    st.success("Text extracted. Sending to LLM...")
 
-                if llm_index_content:
-                    st.subheader("Generated Index Content (from LLM):")
-                    # Displaying a very long code block in Streamlit can be slow.
-                    # You might consider showing only the first N lines or a scrollable area.
-                    st.code(llm_index_content[:5000] + "...\n(truncated for display, download PDF for full content)" if len(llm_index_content) > 5000 else llm_index_content, language='text')
+                    # Local pre-indexing: strip running headers/footers, build the term index
+                    with metrics.stage("preprocess", pages=len(pdf_text_data)) as event:
+                        llm_pages = preprocess_pages(pdf_text_data)
+                        term_index, page_terms = build_term_index(llm_pages)
+                        if use_digests:
+                            llm_pages = build_page_digests(llm_pages, page_terms)
+                        event["terms"] = len(term_index)
+                    st.caption(
+                        f"Pre-indexing: {sum(len(item['text']) for item in pdf_text_data)} characters extracted, "
+                        f"{sum(len(item['text']) for item in llm_pages)} sent; {len(term_index)} candidate terms found."
+                    )
 
-                    # 3. Create output PDF
-                    output_pdf_filename = f"teacher_guide_index_{uploaded_file.name.replace('.pdf', '')}.pdf"
-                    created_pdf_path = create_pdf_from_text(llm_index_content, output_pdf_filename)
+                    request_stats = []
+                    with metrics.stage("generate", pages=len(llm_pages), mode=mode) as event:
+                        if use_map_reduce:
+                            llm_index_content = generate_teacher_guide_index_map_reduce(
+                                chat_model, llm_pages, request_stats=request_stats
+                            )
+                        else:
+                            st.subheader("Generated Index Content (from LLM):")
+                            llm_index_content, parsed_index = stream_index_to_streamlit(
+                                chat_model, llm_pages, request_stats=request_stats
+                            )
+                        event.update(summarize_request_stats(request_stats))
 
-                    if created_pdf_path and os.path.exists(created_pdf_path):
-                        with open(created_pdf_path, "rb") as pdf_file:
-                            st.download_button(
-                                label="Download Generated Teacher Guide Index PDF",
-                                data=pdf_file,
-                                file_name=output_pdf_filename,
-                                mime="application/pdf"
+                    if request_stats:
+                        with st.expander("LLM request stats"):
+                            st.caption(
+                                f"{len(request_stats)} requests: "
+                                f"{sum(r['input_tokens'] for r in request_stats)} input tokens "
+                                f"({sum(r['cached_tokens'] for r in request_stats)} read from prompt cache), "
+                                f"{sum(r['output_tokens'] for r in request_stats)} output tokens"
                             )
-                        os.remove(created_pdf_path) # Clean up generated PDF
+                            st.dataframe(request_stats)
+
+                    # Only complete indexes are cached, so a truncated run is retried next time.
+                    if llm_index_content and END_OF_INDEX_MARKER in llm_index_content:
+                        cache.put_index(pdf_hash, llm_index_content, mode)
+                    elif not llm_index_content:
+                        st.error("LLM failed to generate index content.")
                 else:
-                    st.error("LLM failed to generate index content.")
+                    st.error("Failed to extract text from PDF.")
+
+        if llm_index_content:
+            if parsed_index is None:
+                st.subheader("Generated Index Content (from LLM):")
+                # Displaying a very long code block in Streamlit can be slow.
+                # You might consider showing only the first N lines or a scrollable area.
+                st.code(llm_index_content[:5000] + "...\n(truncated for display, download PDF for full content)" if len(llm_index_content) > 5000 else llm_index_content, language='text')
+
+            if parsed_index is None:
+                parsed_index = parse_index_text(llm_index_content)
+            if term_index:
+                checked, mismatches = validate_index_citations(parsed_index.root, term_index)
+                with st.expander(f"Citation check: {len(mismatches)} of {checked} checkable entries cite pages without the term"):
+                    st.caption("Entries whose heading was found locally, with cited pages on which the term does not literally appear.")
+                    if mismatches:
+                        st.dataframe(mismatches)
+
+            # 3. Create output PDF in memory and hand it straight to the download button
+            output_pdf_filename = f"teacher_guide_index_{uploaded_file.name.replace('.pdf', '')}.pdf"
+            with metrics.stage("render") as event:
+                output_pdf = create_pdf_from_text(llm_index_content, io.BytesIO(), parsed=parsed_index)
+                event["entries"] = sum(1 for _ in parsed_index.root.walk())
+
+            if output_pdf:
+                st.download_button(
+                    label="Download Generated Teacher Guide Index PDF",
+                    data=output_pdf.getvalue(),
+                    file_name=output_pdf_filename,
+                    mime="application/pdf"
+                )
+
+        stats = cache.stats()
+        st.caption(
+            f"Cache: {stats.get('index_hits', 0)} index hits / {stats.get('index_misses', 0)} misses, "
+            f"{stats.get('pages_hits', 0)} extraction hits / {stats.get('pages_misses', 0)} misses, "
+            f"{stats['entries']} entries ({stats['bytes'] / (1024 * 1024):.1f} MB)"
+        )
+
+        with st.expander("Debug: pipeline metrics"):
+            if metrics.events:
+                st.dataframe(metrics.events)
             else:
-                st.error("Failed to extract text from PDF.")
+                st.caption("No pipeline stages ran (cached result).")
+
+
+# --- For batch / command-line use ---
+BATCH_JOURNAL_NAME = "batch_journal.jsonl"
+
+
+def iter_batch_inputs(source):
+    """
+    Lists the PDFs to index: every *.pdf in a directory (sorted by name), or the paths
+    listed one per line in a manifest file (relative to the manifest; '#' starts a comment).
+    """
+    if os.path.isdir(source):
+        return [os.path.join(source, name) for name in sorted(os.listdir(source)) if name.lower().endswith(".pdf")]
+    base_dir = os.path.dirname(os.path.abspath(source))
+    with open(source, encoding="utf-8") as manifest:
+        paths = [line.split("#", 1)[0].strip() for line in manifest]
+    return [os.path.join(base_dir, path) for path in paths if path]
+
+
+def load_batch_journal(journal_path):
+    """
+    Returns {sha256: record} for documents the journal records as done, so a restarted
+    batch skips them. Later records for the same document override earlier ones.
+    """
+    done = {}
+    if not os.path.exists(journal_path):
+        return done
+    with open(journal_path, encoding="utf-8") as journal:
+        for line in journal:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue # A line cut short by a crash
+            if record.get("status") == "done":
+                done[record["sha256"]] = record
+            else:
+                done.pop(record.get("sha256"), None)
+    return done
+
+
+def _append_journal(journal_path, record):
+    with open(journal_path, "a", encoding="utf-8") as journal:
+        journal.write(json.dumps(record) + "\n")
+        journal.flush()
+        os.fsync(journal.fileno())
+
+
+def _file_content_hash(pdf_path):
+    """pdf_content_hash of a file on disk, read in blocks rather than all at once."""
+    digest = hashlib.sha256()
+    with open(pdf_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def batch_output_path(pdf_path, output_dir):
+    """
+    Where the batch writes the index PDF for pdf_path. A short hash of the absolute path keeps
+    same-named workbooks from different directories from overwriting each other's output.
+    """
+    name = os.path.splitext(os.path.basename(pdf_path))[0]
+    path_hash = hashlib.sha256(os.path.abspath(pdf_path).encode("utf-8")).hexdigest()[:8]
+    return os.path.join(output_dir, f"teacher_guide_index_{name}_{path_hash}.pdf")
+
+
+def _extract_document(pdf_path):
+    """Process-pool worker: extracts one whole document serially."""
+    return extract_text_with_page_numbers(pdf_path, workers=1)
+
+
+def _prepare_llm_pages(pages, use_digests):
+    """Returns (llm_pages, term_index): the preprocessed (or digested) pages and their term index."""
+    llm_pages = preprocess_pages(pages)
+    term_index, page_terms = build_term_index(llm_pages)
+    if use_digests:
+        llm_pages = build_page_digests(llm_pages, page_terms)
+    return llm_pages, term_index
+
+
+def _parse_and_validate(index_text, term_index):
+    """Returns (parsed, checked, mismatches) for the generated index text."""
+    parsed = parse_index_text(index_text)
+    checked, mismatches = validate_index_citations(parsed.root, term_index)
+    return parsed, checked, mismatches
+
+
+def _write_sidecar(path, sidecar):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(sidecar, f, ensure_ascii=False, indent=2)
+
+
+async def _index_document(pdf_path, chat_model, output_dir, journal_path, done, extract_pool,
+                          llm_semaphore, document_semaphore, cache, use_digests=False):
+    """
+    Indexes one PDF: extraction in the process pool, map-reduce generation under the shared
+    LLM semaphore, then the output PDF, its JSON sidecar and a journal record. Blocking
+    work (cache I/O, preprocessing, parsing, file writes) runs in threads so it never
+    stalls the event loop that drives the other documents' requests.
+    Returns the journal record.
+    """
+    async with document_semaphore:
+        started = time.perf_counter()
+        record = {"pdf": pdf_path, "status": "failed"}
+        try:
+            # Reading and hashing a large PDF would otherwise stall every other document's requests
+            pdf_hash = await asyncio.to_thread(_file_content_hash, pdf_path)
+            record["sha256"] = pdf_hash
+            if pdf_hash in done and os.path.exists(done[pdf_hash].get("output", "")):
+                print(f"Skipping '{pdf_path}': already indexed in {done[pdf_hash]['output']}")
+                return dict(done[pdf_hash], skipped=True)
+
+            loop = asyncio.get_running_loop()
+            extract_started = time.perf_counter()
+            pages = await asyncio.to_thread(cache.get_pages, pdf_hash)
+            if pages is None:
+                pages = await loop.run_in_executor(extract_pool, _extract_document, pdf_path)
+                if not pages:
+                    raise ValueError("no text could be extracted")
+                await asyncio.to_thread(cache.put_pages, pdf_hash, pages)
+            extract_seconds = time.perf_counter() - extract_started
+
+            llm_pages, term_index = await asyncio.to_thread(_prepare_llm_pages, pages, use_digests)
+
+            llm_started = time.perf_counter()
+            request_stats = []
+            mode = "map_reduce+digests" if use_digests else "map_reduce"
+            index_text = await asyncio.to_thread(cache.get_index, pdf_hash, mode)
+            if index_text is None:
+                index_text = await agenerate_teacher_guide_index_map_reduce(
+                    chat_model, llm_pages, request_stats=request_stats, semaphore=llm_semaphore
+                )
+                if not index_text:
+                    raise ValueError("the LLM did not return any index content")
+                if END_OF_INDEX_MARKER in index_text:
+                    await asyncio.to_thread(cache.put_index, pdf_hash, index_text, mode)
+            llm_seconds = time.perf_counter() - llm_started
+
+            parsed, checked, mismatches = await asyncio.to_thread(_parse_and_validate, index_text, term_index)
+            output_pdf_path = batch_output_path(pdf_path, output_dir)
+            created = await asyncio.to_thread(create_pdf_from_text, index_text, output_pdf_path, parsed)
+            if not created:
+                raise ValueError("the index PDF could not be created")
+
+            seconds = time.perf_counter() - started
+            record.update(
+                status="done",
+                output=output_pdf_path,
+                complete=parsed.complete and not parsed.incomplete,
+                pages=len(pages),
+                characters_extracted=sum(len(item["text"]) for item in pages),
+                characters_sent=sum(len(item["text"]) for item in llm_pages),
+                seconds=round(seconds, 2),
+                extract_seconds=round(extract_seconds, 2),
+                llm_seconds=round(llm_seconds, 2),
+                pages_per_second=round(len(pages) / seconds, 2) if seconds else None,
+                input_tokens=sum(r["input_tokens"] for r in request_stats),
+                cached_tokens=sum(r["cached_tokens"] for r in request_stats),
+                output_tokens=sum(r["output_tokens"] for r in request_stats),
+                requests=len(request_stats),
+                citations_checked=checked,
+                citation_mismatches=len(mismatches),
+            )
+            sidecar = dict(record, index=[entry.to_dict() for entry in parsed.root.sorted_children()],
+                           request_stats=request_stats, citation_mismatches=mismatches)
+            await asyncio.to_thread(_write_sidecar, os.path.splitext(output_pdf_path)[0] + ".json", sidecar)
+            print(f"Indexed '{pdf_path}': {len(pages)} pages in {seconds:.1f}s "
+                  f"({record['pages_per_second']} pages/s) -> {output_pdf_path}")
+        except Exception as e:
+            record.update(error=str(e), seconds=round(time.perf_counter() - started, 2))
+            print(f"Error indexing '{pdf_path}': {str(e)}")
+        await asyncio.to_thread(_append_journal, journal_path, record)
+        return record
+
+
+async def run_batch(pdf_paths, output_dir, extract_workers=EXTRACTION_WORKERS, concurrency=LLM_CONCURRENCY,
+                    max_documents=None, resume=True, use_digests=False, chat_model=None):
+    """
+    Indexes many PDFs concurrently: text extraction runs in a process pool of
+    `extract_workers`, LLM requests across all documents share a limit of `concurrency`,
+    and at most `max_documents` are held in memory at once. Progress is journalled to
+    output_dir/batch_journal.jsonl; with resume, documents already done are skipped.
+    With use_digests, per-page term digests are sent to the LLM instead of the full text.
+    Returns the list of per-document records.
+    """
+    chat_model = chat_model or initialize_chat_model(max_retries=0)
+    if not chat_model:
+        return []
+
+    os.makedirs(output_dir, exist_ok=True)
+    journal_path = os.path.join(output_dir, BATCH_JOURNAL_NAME)
+    done = load_batch_journal(journal_path) if resume else {}
+    llm_semaphore = asyncio.Semaphore(concurrency)
+    document_semaphore = asyncio.Semaphore(max_documents or extract_workers + concurrency)
+    cache = shared_index_cache()
+
+    with ProcessPoolExecutor(max_workers=extract_workers) as extract_pool:
+        return await asyncio.gather(*(
+            _index_document(pdf_path, chat_model, output_dir, journal_path, done, extract_pool,
+                            llm_semaphore, document_semaphore, cache, use_digests)
+            for pdf_path in pdf_paths
+        ))
+
+
+def run_batch_cli(argv=None):
+    """
+    Command-line entry point: `python teacher_index.py <directory-or-manifest> [options]`.
+    Returns the process exit code (1 if any document failed).
+    """
+    parser = argparse.ArgumentParser(description="Generate teacher guide index PDFs for a directory or manifest of workbooks.")
+    parser.add_argument("source", help="Directory of PDFs, or a text file listing one PDF path per line")
+    parser.add_argument("-o", "--output-dir", default="indexes", help="Where to write index PDFs, JSON sidecars and the journal")
+    parser.add_argument("--extract-workers", type=int, default=EXTRACTION_WORKERS, help="Processes used for text extraction")
+    parser.add_argument("--concurrency", type=int, default=LLM_CONCURRENCY, help="Maximum LLM requests in flight")
+    parser.add_argument("--max-documents", type=int, default=None, help="Maximum documents in progress at once")
+    parser.add_argument("--no-resume", action="store_true", help="Ignore the progress journal and index every document")
+    parser.add_argument("--digests", action="store_true", help="Send per-page term digests instead of full page text")
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.source):
+        print(f"Error: '{args.source}' does not exist.")
+        return 1
+    pdf_paths = iter_batch_inputs(args.source)
+    if not pdf_paths:
+        print(f"No PDFs found in '{args.source}'.")
+        return 1
+
+    started = time.perf_counter()
+    records = asyncio.run(run_batch(
+        pdf_paths, args.output_dir, extract_workers=args.extract_workers, concurrency=args.concurrency,
+        max_documents=args.max_documents, resume=not args.no_resume, use_digests=args.digests
+    ))
+    elapsed = time.perf_counter() - started
 
-        if os.path.exists(temp_pdf_path):
-            os.remove(temp_pdf_path) # Clean up temporary uploaded PDF
+    indexed = [r for r in records if r["status"] == "done" and not r.get("skipped")]
+    skipped = [r for r in records if r.get("skipped")]
+    failed = [r for r in records if r["status"] != "done"]
+    total_pages = sum(r["pages"] for r in indexed)
+    print(
+        f"Batch finished in {elapsed:.1f}s: {len(indexed)} indexed, {len(skipped)} skipped, {len(failed)} failed. "
+        f"{total_pages} pages at {total_pages / elapsed:.2f} pages/s, "
+        f"{len(indexed) / (elapsed / 60):.2f} docs/min."
+    )
+    return 1 if failed or not records else 0
 
 
 if __name__ == "__main__":
-    run_streamlit_app()
\ No newline at end of file
+    if _in_streamlit():
+        run_streamlit_app()
+    else:
+        sys.exit(run_batch_cli())
\ No newline at end of file
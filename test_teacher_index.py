@@ -0,0 +1,441 @@
+"""
+Behaviour tests for the teacher guide index pipeline. The LLM is replaced by a scripted
+chat model, so no API token or network access is needed:
+
+    python -m pytest -q test_teacher_index.py
+"""
+import asyncio
+import json
+import os
+import time
+import zlib
+
+import pytest
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+import benchmark_teacher_index
+import teacher_index
+
+
+@pytest.fixture(scope="module")
+def workbook_pdf(tmp_path_factory):
+    path = tmp_path_factory.mktemp("workbook") / "workbook.pdf"
+    # More pages than EXTRACTION_SHARD_SIZE, so extraction with workers > 1 uses the pool.
+    benchmark_teacher_index.make_synthetic_workbook(str(path), pages=30, lines_per_page=3)
+    return str(path)
+
+
+# --- Page extraction (user-001) ---
+
+def test_parallel_extraction_matches_serial(workbook_pdf):
+    serial = list(teacher_index.iter_text_with_page_numbers(workbook_pdf, workers=1))
+    parallel = list(teacher_index.iter_text_with_page_numbers(workbook_pdf, workers=2, shard_size=5))
+    assert [item["page"] for item in serial] == list(range(1, 31))
+    assert parallel == serial
+
+
+@pytest.mark.parametrize("error", [PermissionError, NotImplementedError])
+def test_extraction_falls_back_to_serial_when_pool_cannot_be_created(workbook_pdf, monkeypatch, error):
+    def unavailable(*args, **kwargs):
+        raise error("no process support")
+
+    serial = list(teacher_index.iter_text_with_page_numbers(workbook_pdf, workers=1))
+    monkeypatch.setattr(teacher_index, "ProcessPoolExecutor", unavailable)
+    assert teacher_index.extract_text_with_page_numbers(workbook_pdf, workers=2) == serial
+
+
+# --- Extraction and index cache (user-002) ---
+
+def test_index_cache_evicts_least_recently_used(tmp_path, monkeypatch):
+    clock = iter(range(1000))
+    monkeypatch.setattr(time, "time", lambda: next(clock))
+    value = [{"page": 1, "text": "x" * 50}]
+    entry_size = len(zlib.compress(json.dumps(value).encode("utf-8")))
+    cache = teacher_index.IndexCache(path=str(tmp_path / "cache.sqlite3"), max_bytes=2 * entry_size)
+
+    cache.put_pages("a", value)
+    cache.put_pages("b", value)
+    assert cache.get_pages("a") == value  # refreshes 'a', leaving 'b' least recently used
+    cache.put_pages("c", value)
+
+    assert cache.get_pages("b") is None
+    assert cache.get_pages("a") == value and cache.get_pages("c") == value
+    assert cache.stats()["entries"] == 2
+
+
+def test_index_cache_keys_indexes_by_mode(tmp_path):
+    cache = teacher_index.IndexCache(path=str(tmp_path / "cache.sqlite3"))
+    cache.put_index("pdf", "Alpha: Page 1", mode="single")
+    assert cache.get_index("pdf", mode="single") == "Alpha: Page 1"
+    assert cache.get_index("pdf", mode="map_reduce") is None
+
+
+# --- Structured index parsing (user-004) ---
+
+PROMPT_EXAMPLE = (
+    "Assessment:\n"
+    "  End-of-Unit Assessment: Page 101, Page 98\n"
+    "  Informal Assessment: See Daily Routines\n"
+    "Fluency:\n"
+    "  Accuracy, read with. See Fluency.\n"
+    "  Words correct per minute (WCPM): Page 55\n"
+    "Phonics:\n"
+    "  Long Vowels:\n"
+    "    ai/ay: Page 4, Page 5\n"
+    "  Short vowels: Page 122\n"
+)
+
+
+def test_prompt_example_round_trips():
+    parser = teacher_index.parse_index_text(PROMPT_EXAMPLE + "--- END OF INDEX ---")
+    assert parser.complete and not parser.incomplete
+    rendered = teacher_index.render_index_text(parser.root)
+    assert teacher_index.render_index_text(teacher_index.parse_index_text(rendered).root) == rendered
+
+    assessment = parser.root.children["assessment"]
+    assert assessment.children["end-of-unit assessment"].pages == {(0, 98), (0, 101)}
+    assert assessment.children["informal assessment"].see == ["Daily Routines"]
+    assert parser.root.children["phonics"].children["long vowels"].children["ai/ay"].pages == {(0, 4), (0, 5)}
+
+
+def test_page_ranges_collapse_and_keep_units():
+    parser = teacher_index.parse_index_text("Vowels: Page 7, Pages 3-5, Page 6, 1/101, 1/102, 2/101")
+    entry = parser.root.children["vowels"]
+    assert entry.pages == {(0, 3), (0, 4), (0, 5), (0, 6), (0, 7), (1, 101), (1, 102), (2, 101)}
+    assert entry.format_line() == "Vowels: Pages 3-7, 1/101-102, 2/101"
+
+
+def test_comma_introduced_page_references():
+    entry = teacher_index.parse_index_text("Vowels, Page 4, Page 9").root.children["vowels"]
+    assert entry.pages == {(0, 4), (0, 9)}
+
+
+def test_see_and_see_also():
+    parser = teacher_index.parse_index_text(
+        "Abbreviations, understand. See Vocabulary.\n"
+        "Plot: Pages 3-5\n"
+        "  See also Story elements\n"
+        "Vowels: Page 4. See also Phonics; Spelling.\n"
+        "Words to Know\n"
+        "  See Vocabulary\n"
+    )
+    root = parser.root
+    assert root.children["abbreviations, understand"].see == ["Vocabulary"]
+    assert root.children["plot"].see_also == ["Story elements"]
+    assert root.children["vowels"].see_also == ["Phonics", "Spelling"]
+    assert root.children["vowels"].format_line() == "Vowels: Page 4. See also Phonics; Spelling."
+    assert root.children["words to know"].see == ["Vocabulary"]
+
+
+def test_heading_starting_with_see_is_not_a_cross_reference():
+    root = teacher_index.parse_index_text("Plot: Pages 3-5\nSee and Say Game: Page 7").root
+    assert root.children["plot"].see == [] and root.children["plot"].see_also == []
+    assert root.children["see and say game"].pages == {(0, 7)}
+
+
+def test_prose_and_letter_lines_are_not_entries():
+    parser = teacher_index.parse_index_text(
+        "Here is the Teacher's Guide Index:\n"
+        "\n"
+        "A\n"
+        "Alpha: Page 1\n"
+        "B\n"
+        "Beta:\n"
+        "  Bravo: Page 2\n"
+        "I hope this index is helpful!\n"
+        "--- END OF INDEX ---\n"
+    )
+    assert teacher_index.render_index_text(parser.root) == "Alpha: Page 1\nBeta:\n  Bravo: Page 2\n--- END OF INDEX ---"
+
+
+def test_merge_combines_pages_children_and_cross_references():
+    first = teacher_index.parse_index_text("Phonics:\n  Short vowels: Page 2\nVowels: Page 1. See Phonics.").root
+    second = teacher_index.parse_index_text("phonics:\n  Short vowels: Page 3\nVowels: Page 1. See Phonics.").root
+    first.merge(second)
+    assert first.children["phonics"].children["short vowels"].pages == {(0, 2), (0, 3)}
+    assert first.children["vowels"].see == ["Phonics"]
+
+
+# --- Map-reduce over page chunks (user-003) ---
+
+def test_chunks_respect_token_budget_and_page_order():
+    pages = [{"page": n, "text": "word " * 40} for n in range(1, 11)]
+    page_tokens = teacher_index._estimate_tokens(teacher_index._format_page_for_prompt(pages[0]))
+    chunks = teacher_index.chunk_pages_by_token_budget(pages, token_budget=3 * page_tokens)
+    assert [[item["page"] for item in chunk] for chunk in chunks] == [[1, 2, 3], [4, 5, 6], [7, 8, 9], [10]]
+
+
+def test_chunk_larger_than_budget_stands_alone():
+    pages = [{"page": 1, "text": "a"}, {"page": 2, "text": "word " * 500}, {"page": 3, "text": "b"}]
+    chunks = teacher_index.chunk_pages_by_token_budget(pages, token_budget=50)
+    assert [[item["page"] for item in chunk] for chunk in chunks] == [[1], [2], [3]]
+
+
+def test_merge_partial_indexes_drops_preambles_and_joins_overlapping_ranges():
+    merged = teacher_index.merge_partial_indexes([
+        "Here is the index:\nVowels: Pages 3-6\nPhonics:\n  Short vowels: Page 2\n--- END OF INDEX ---",
+        "Here is the index for these pages:\n\nphonics:\n  short vowels: Pages 5-6\nVowels: Pages 5-9, 1/101\n--- END OF INDEX ---",
+    ])
+    assert merged == (
+        "Phonics:\n"
+        "  Short vowels: Page 2, Pages 5-6\n"
+        "Vowels: Pages 3-9, 1/101\n"
+        "--- END OF INDEX ---"
+    )
+
+
+def test_merge_partial_indexes_is_incomplete_if_any_chunk_is():
+    merged = teacher_index.merge_partial_indexes([
+        "Alpha: Page 1\n--- END OF INDEX ---",
+        "Beta: Page 9\n--- INDEX INCOMPLETE ---",
+    ])
+    assert merged == "Alpha: Page 1\nBeta: Page 9\n--- INDEX INCOMPLETE ---"
+
+
+# --- Token budgeting (user-005) ---
+
+class CountingTokenizer:
+    """Counts tokens as `ratio` times the four-characters-per-token estimate, recording each call."""
+
+    def __init__(self, ratio=1.0):
+        self.ratio = ratio
+        self.calls = 0
+
+    def get_num_tokens_from_messages(self, messages, tools=None):
+        self.calls += 1
+        return int(teacher_index._estimate_tokens(teacher_index._message_text(messages[0])) * self.ratio)
+
+
+PAGES_OF_100_TOKENS = [{"page": n, "text": "x" * 380} for n in range(1, 21)]
+
+
+def test_pack_pages_trims_to_the_exact_count():
+    tokenizer = CountingTokenizer(ratio=2.0)
+    selected, truncated = teacher_index.pack_pages_to_token_budget(tokenizer, PAGES_OF_100_TOKENS, token_budget=1000)
+    assert truncated and tokenizer.calls >= 1
+    assert 0 < len(selected) <= 5
+    assert selected == PAGES_OF_100_TOKENS[:len(selected)]
+
+
+def test_pack_pages_skips_the_exact_count_well_under_budget():
+    tokenizer = CountingTokenizer()
+    selected, truncated = teacher_index.pack_pages_to_token_budget(tokenizer, PAGES_OF_100_TOKENS[:5], token_budget=10000)
+    assert selected == PAGES_OF_100_TOKENS[:5] and not truncated
+    assert tokenizer.calls == 0
+
+
+# --- Continuation of truncated responses (user-007) ---
+
+class ScriptedChatModel(BaseChatModel):
+    """Replies with the next (text, stop_reason) pair from `rounds` on each request."""
+    rounds: list
+    calls: int = 0
+
+    @property
+    def _llm_type(self):
+        return "scripted"
+
+    def get_num_tokens_from_messages(self, messages, tools=None):
+        return 10
+
+    def _next_round(self):
+        text, stop_reason = self.rounds[self.calls]
+        self.calls += 1
+        return text, stop_reason
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        text, stop_reason = self._next_round()
+        message = AIMessage(content=text, response_metadata={"stop_reason": stop_reason})
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        text, stop_reason = self._next_round()
+        lines = text.split("\n")
+        for i, line in enumerate(lines):
+            last = i == len(lines) - 1
+            yield ChatGenerationChunk(message=AIMessageChunk(
+                content=line if last else line + "\n",
+                response_metadata={"stop_reason": stop_reason} if last else {},
+            ))
+
+
+def _stream_all(model):
+    """Returns (streamed lines, returned text) of stream_index_lines."""
+    stream = teacher_index.stream_index_lines(model, PAGES)
+    lines = []
+    while True:
+        try:
+            lines.append(next(stream))
+        except StopIteration as stop:
+            return lines, stop.value
+
+
+# Round 1 is cut off by max_tokens partway through the Fluency entry; round 2 resumes it.
+TRUNCATED_ROUND = ("Accuracy, read with: Page 2\nFluency:\n  Accuracy: Page 3\n  Expression: Pa", "max_tokens")
+RESUMED_ROUND = ("Fluency:\n  Accuracy: Page 3\n  Expression: Page 4\nPhonics: Page 5\n--- END OF INDEX ---", "end_turn")
+STITCHED_INDEX = (
+    "Accuracy, read with: Page 2\n"
+    "Fluency:\n"
+    "  Accuracy: Page 3\n"
+    "  Expression: Page 4\n"
+    "Phonics: Page 5\n"
+    "--- END OF INDEX ---"
+)
+PAGES = [{"page": 1, "text": "Fluency"}]
+
+
+def test_continuation_after_max_tokens_stitches_without_duplicates():
+    model = ScriptedChatModel(rounds=[TRUNCATED_ROUND, RESUMED_ROUND])
+    assert teacher_index.generate_teacher_guide_index_with_llm(model, PAGES) == STITCHED_INDEX
+    assert model.calls == 2
+
+
+def test_streamed_continuation_does_not_repeat_the_resumed_entry():
+    lines, result = _stream_all(ScriptedChatModel(rounds=[TRUNCATED_ROUND, RESUMED_ROUND]))
+    assert "\n".join(lines) == STITCHED_INDEX
+    assert result == STITCHED_INDEX
+
+
+def test_continuation_preamble_is_dropped():
+    preamble = "Here is the continuation of the index, starting with 'Fluency':\n\n"
+    resumed = (preamble + RESUMED_ROUND[0], RESUMED_ROUND[1])
+
+    model = ScriptedChatModel(rounds=[TRUNCATED_ROUND, resumed])
+    assert teacher_index.generate_teacher_guide_index_with_llm(model, PAGES) == STITCHED_INDEX
+
+    lines, result = _stream_all(ScriptedChatModel(rounds=[TRUNCATED_ROUND, resumed]))
+    assert "\n".join(lines) == STITCHED_INDEX
+    assert result == STITCHED_INDEX
+
+
+def test_continuation_stops_at_round_limit(monkeypatch):
+    monkeypatch.setattr(teacher_index, "MAX_INDEX_ROUNDS", 2)
+    rounds = [("Alpha: Page 1\nBeta: Pa", "max_tokens"), ("Beta: Page 2\nGamma: Pa", "max_tokens")]
+    text = teacher_index.generate_teacher_guide_index_with_llm(ScriptedChatModel(rounds=rounds), PAGES)
+    assert text == "Alpha: Page 1\nBeta: Page 2\n--- INDEX INCOMPLETE ---"
+
+
+# --- Batch indexing (user-008) ---
+
+def test_load_batch_journal_keeps_latest_done_records(tmp_path):
+    journal = tmp_path / teacher_index.BATCH_JOURNAL_NAME
+    journal.write_text(
+        json.dumps({"sha256": "a", "status": "done", "output": "a.pdf"}) + "\n"
+        + json.dumps({"sha256": "b", "status": "done", "output": "b.pdf"}) + "\n"
+        + json.dumps({"sha256": "b", "status": "failed"}) + "\n"
+        + '{"sha256": "c", "sta',  # cut short by a crash
+        encoding="utf-8",
+    )
+    assert teacher_index.load_batch_journal(str(journal)) == {"a": {"sha256": "a", "status": "done", "output": "a.pdf"}}
+    assert teacher_index.load_batch_journal(str(tmp_path / "missing.jsonl")) == {}
+
+
+def test_batch_output_paths_differ_for_same_named_inputs(tmp_path):
+    first = teacher_index.batch_output_path(str(tmp_path / "unit1" / "guide.pdf"), str(tmp_path))
+    second = teacher_index.batch_output_path(str(tmp_path / "unit2" / "guide.pdf"), str(tmp_path))
+    assert first != second
+    assert first == teacher_index.batch_output_path(str(tmp_path / "unit1" / "guide.pdf"), str(tmp_path))
+
+
+def test_run_batch_indexes_same_named_inputs_and_skips_them_on_resume(tmp_path, monkeypatch):
+    cache = teacher_index.IndexCache(path=str(tmp_path / "cache.sqlite3"))
+    monkeypatch.setattr(teacher_index, "shared_index_cache", lambda: cache)
+    pdf_paths = []
+    for unit, pages in (("unit1", 3), ("unit2", 4)):
+        (tmp_path / unit).mkdir()
+        pdf_paths.append(str(tmp_path / unit / "guide.pdf"))
+        benchmark_teacher_index.make_synthetic_workbook(pdf_paths[-1], pages=pages, lines_per_page=3)
+    output_dir = str(tmp_path / "indexes")
+    model = benchmark_teacher_index.FakeIndexChatModel(latency=0)
+
+    def batch():
+        return asyncio.run(teacher_index.run_batch(pdf_paths, output_dir, extract_workers=1, chat_model=model))
+
+    records = batch()
+    assert [r["status"] for r in records] == ["done", "done"]
+    assert records[0]["output"] != records[1]["output"]
+    assert all(os.path.exists(r["output"]) for r in records)
+
+    resumed = batch()
+    assert all(r.get("skipped") for r in resumed)
+    assert [r["output"] for r in resumed] == [r["output"] for r in records]
+
+
+# --- Preprocessing and vocabulary (user-009) ---
+
+
+
+def test_preprocess_strips_running_headers_and_footers():
+    pages = [
+        {"page": n, "text": f"Student Workbook\nLesson {n}: Vowels\nRead   the words aloud.\nUnit 1 • Page {n}"}
+        for n in range(1, 7)
+    ]
+    cleaned = teacher_index.preprocess_pages(pages)
+    assert [item["page"] for item in cleaned] == list(range(1, 7))
+    assert cleaned[0]["text"] == "Lesson 1: Vowels\nRead the words aloud."
+
+
+@pytest.mark.parametrize("term", ["Daily", "Phonemic", "Games Decoding games", "Independent Activities Initial sounds"])
+def test_reference_vocabulary_has_no_run_on_fragments(term):
+    assert term not in teacher_index.reference_vocabulary()
+
+
+def test_single_word_terms_only_match_as_headings():
+    terms = teacher_index.extract_page_terms("Follow the directions daily.\nCompound words\nDirections")
+    assert terms == ["Compound words", "Directions"]
+
+
+# --- Spilling large uploads to disk (user-010) ---
+
+def test_spooled_pdf_source_keeps_small_uploads_in_memory():
+    with teacher_index.spooled_pdf_source(b"%PDF-small", spill_bytes=100) as source:
+        assert source == b"%PDF-small"
+
+
+def test_spooled_pdf_source_spills_large_uploads_and_removes_the_copy():
+    pdf_bytes = b"%PDF-" + b"x" * 200
+    with teacher_index.spooled_pdf_source(pdf_bytes, spill_bytes=100) as source:
+        assert isinstance(source, str)
+        with open(source, "rb") as f:
+            assert f.read() == pdf_bytes
+    assert not os.path.exists(source)
+
+
+def test_spilled_upload_extracts_like_the_bytes(workbook_pdf):
+    with open(workbook_pdf, "rb") as f:
+        pdf_bytes = f.read()
+    in_memory = teacher_index.extract_text_with_page_numbers(pdf_bytes, workers=1)
+    with teacher_index.spooled_pdf_source(pdf_bytes, spill_bytes=0) as source:
+        assert teacher_index.extract_text_with_page_numbers(source, workers=2) == in_memory
+
+
+# --- Pipeline instrumentation (user-011) ---
+
+def test_metrics_stage_records_error_and_reraises(tmp_path):
+    metrics = teacher_index.PipelineMetrics(run_id="test", log_path=str(tmp_path / "metrics.jsonl"))
+    with pytest.raises(ValueError, match="boom"):
+        with metrics.stage("extract", pages=3):
+            raise ValueError("boom")
+    [event] = metrics.events
+    assert event["stage"] == "extract" and event["status"] == "error" and event["error"] == "boom"
+    assert json.loads((tmp_path / "metrics.jsonl").read_text(encoding="utf-8")) == event
+
+
+def test_unwritable_metrics_log_does_not_mask_the_stage_error(tmp_path):
+    metrics = teacher_index.PipelineMetrics(log_path=str(tmp_path / "missing" / "metrics.jsonl"))
+    with pytest.raises(ValueError, match="boom"):
+        with metrics.stage("extract"):
+            raise ValueError("boom")
+    assert metrics.events[0]["status"] == "error"
+
+
+def test_benchmark_handles_a_stream_without_lines(workbook_pdf, monkeypatch):
+    def no_lines(chat_model, pages, request_stats=None):
+        return iter(())
+
+    monkeypatch.setattr(teacher_index, "stream_index_lines", no_lines)
+    events = benchmark_teacher_index.run_benchmark(workbook_pdf, latency=0, workers=1, concurrency=2)
+    [single] = [event for event in events if event["stage"] == "generate_single"]
+    assert single["status"] == "ok" and single["first_line_seconds"] is None